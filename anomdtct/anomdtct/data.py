@@ -212,10 +212,10 @@ def prepare_training_data(data, training_start, training_end):
         clean_data[c] = data.query("geo==@c").rename(
             columns={"date": "ds", "value": "y"}
         ).sort_values("ds")
-        clean_data[c]['ds'] = pd.to_datetime(clean_data[c]['ds']).dt.date
+        clean_data[c]['ds'] = pd.to_datetime(clean_data[c]['ds'])
         clean_data[c] = clean_data[c].set_index('ds')
         clean_training_data[c] = clean_data[c][
-            training_start:training_end
+            pd.Timestamp(training_start):pd.Timestamp(training_end)
         ].reset_index()
         clean_data[c] = clean_data[c].reset_index()
     return clean_training_data
@@ -232,9 +232,7 @@ def prepare_data(data):
         clean_data[c] = data.query("geo==@c").rename(
             columns={"date": "ds", "value": "y"}
         ).sort_values("ds")
-        clean_data[c]['ds'] = pd.to_datetime(clean_data[c]['ds']).dt.date
-        clean_data[c] = clean_data[c].set_index('ds')
-        clean_data[c] = clean_data[c].reset_index()
+        clean_data[c]['ds'] = pd.to_datetime(clean_data[c]['ds'])
     return clean_data
 
 
@@ -87,7 +87,7 @@ def forecast(data, bq_client, model_cache_table, metric, model_date):
         if model is None:
             continue
 
-        time_delta = (model_date - model.history_dates.max().date()).days
+        time_delta = (pd.Timestamp(model_date) - model.history_dates.max()).days
 
         forecast_period = model.make_future_dataframe(
             periods=time_delta,
@@ -96,7 +96,6 @@ def forecast(data, bq_client, model_cache_table, metric, model_date):
 
         print(f"Run prediction for {c}")
         forecast[c] = model.predict(forecast_period)
-        forecast[c]['ds'] = pd.to_datetime(forecast[c]['ds']).dt.date
         forecast[c] = forecast[c][["ds", "yhat", "yhat_lower", "yhat_upper"]]
         # We join the forecast with our full data to allow calculation of deviations.
         forecast[c] = forecast[c].merge(data[c], on="ds", how="inner")
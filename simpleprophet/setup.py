@@ -50,8 +50,14 @@ setup(
     install_requires=[
         'fbprophet>=0.5',
         'google-cloud-bigquery>=1.20.0',
-        'plotly>=4.0'
+        'google-cloud-bigquery-storage>=2.0.0',
+        'plotly>=4.0',
+        'pyarrow>=1.0.0',
     ],
+    extras_require={
+        # For running the pipeline against local files with simpleprophet.local
+        'local': ['duckdb>=0.8.0', 'pyarrow>=5.0.0'],
+    },
     packages=['simpleprophet'],
 
     # Specify which Python versions you support. In contrast to the
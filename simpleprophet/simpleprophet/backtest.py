@@ -0,0 +1,124 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+Rolling-origin backtests: fit a model on the data up to each of a range of
+origins and forecast from it.
+"""
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import timedelta
+import logging
+import pickle
+
+import numpy as np
+import pandas as pd
+
+
+BACKTEST_COLUMNS = ["ds", "asofdate", "yhat", "yhat_lower", "yhat_upper"]
+
+# Set in each worker process by _init_worker, so that the model generator and
+# data are sent to a worker once rather than with every origin.
+_worker_state = {}
+
+
+def _init_worker(model_gen, data):
+    _worker_state["model_gen"] = model_gen
+    _worker_state["data"] = data
+
+
+def _fit_origin(model_gen, data, origin, forecast_dates):
+    model = model_gen()
+    model.fit(data[data.ds <= origin])
+    forecast = model.predict(pd.DataFrame({'ds': forecast_dates}))
+    return (
+        forecast.ds.values, forecast.yhat.values,
+        forecast.yhat_lower.values, forecast.yhat_upper.values,
+    )
+
+
+def _fit_origin_in_worker(origin, forecast_dates):
+    return _fit_origin(
+        _worker_state["model_gen"], _worker_state["data"], origin, forecast_dates
+    )
+
+
+def _picklable(obj):
+    try:
+        pickle.dumps(obj)
+        return True
+    except (pickle.PicklingError, AttributeError, TypeError):
+        return False
+
+
+def backtest(model_gen, data, origins, target_dates=None, workers=1, cache=None):
+    """
+    For each origin in origins, fit model_gen() on the rows of data up to the
+    origin and forecast target_dates, or every date after the origin up to
+    the last date in data if target_dates is None.
+
+    Returns a frame with ds, asofdate, yhat, yhat_lower and yhat_upper columns
+    holding the forecasts of every origin in origin order. With more than one
+    worker the fits run on a process pool, which requires model_gen to be
+    picklable, e.g. a module-level function or a functools.partial rather than
+    a lambda; otherwise they run in this process.
+
+    With a cache.FitCache, fits whose model, training data and forecast dates
+    are already in the cache are read from it instead of being refit.
+    """
+    origins = pd.to_datetime(list(origins))
+    last_date = data.ds.max()
+    periods = [
+        pd.DatetimeIndex(target_dates) if target_dates is not None
+        else pd.date_range(origin + timedelta(days=1), last_date)
+        for origin in origins
+    ]
+    # Results are written straight into preallocated columns, each origin
+    # into its own slice.
+    offsets = np.concatenate([[0], np.cumsum([len(p) for p in periods])])
+    columns = {
+        "ds": np.empty(offsets[-1], dtype="datetime64[ns]"),
+        "asofdate": np.repeat(origins.values, np.diff(offsets)),
+        "yhat": np.empty(offsets[-1]),
+        "yhat_lower": np.empty(offsets[-1]),
+        "yhat_upper": np.empty(offsets[-1]),
+    }
+
+    def store(i, result):
+        for name, values in zip(["ds", "yhat", "yhat_lower", "yhat_upper"], result):
+            columns[name][offsets[i]:offsets[i + 1]] = values
+
+    pending = list(range(len(origins)))
+    keys = {}
+    if cache is not None:
+        for i in list(pending):
+            keys[i] = cache.key(model_gen(), data[data.ds <= origins[i]], periods[i])
+            result = cache.get(keys[i])
+            if result is not None:
+                store(i, result)
+                pending.remove(i)
+        logging.info("Fit cache: {hits} hits, {misses} misses".format(**cache.info()))
+
+        def fitted(i, result):
+            store(i, result)
+            cache.put(keys[i], result)
+    else:
+        fitted = store
+
+    if pending and workers is not None and workers > 1 and not _picklable(model_gen):
+        logging.warning("model_gen can't be pickled, so fitting in a single process")
+        workers = 1
+    if workers is None or workers <= 1:
+        for i in pending:
+            fitted(i, _fit_origin(model_gen, data, origins[i], periods[i]))
+    else:
+        with ProcessPoolExecutor(
+            max_workers=workers, initializer=_init_worker, initargs=(model_gen, data)
+        ) as executor:
+            futures = {
+                executor.submit(_fit_origin_in_worker, origins[i], periods[i]): i
+                for i in pending
+            }
+            for future in as_completed(futures):
+                fitted(futures[future], future.result())
+    return pd.DataFrame(columns)[BACKTEST_COLUMNS]
@@ -0,0 +1,222 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+Tools for recognising forecast units and backtest fits whose inputs haven't
+changed.
+"""
+import glob
+import hashlib
+import logging
+import os
+import zipfile
+
+import numpy as np
+import pandas as pd
+
+from simpleprophet.models import get_model, data_filter
+
+
+# Bump when a change to the output code would change results for the same
+# inputs, so that earlier fingerprints no longer match.
+FINGERPRINT_VERSION = 2
+
+# Prophet settings that, together with the training data, determine the fit
+MODEL_ATTRIBUTES = [
+    "growth", "changepoints", "n_changepoints", "changepoint_range",
+    "yearly_seasonality", "weekly_seasonality", "daily_seasonality",
+    "seasonality_mode", "seasonality_prior_scale", "changepoint_prior_scale",
+    "holidays_prior_scale", "holidays_mode", "country_holidays", "mcmc_samples",
+    "interval_width", "uncertainty_samples", "seasonalities", "extra_regressors",
+]
+
+
+def frame_digest(frame):
+    hashes = pd.util.hash_pandas_object(frame, index=False)
+    return hashlib.sha256(hashes.values.tobytes()).hexdigest()
+
+
+# The columns of training data that model's fit reads: besides ds and y, the
+# logistic growth bounds, extra regressors and seasonality conditions.
+def fit_columns(model, training_data):
+    columns = ["ds", "y", "cap", "floor"]
+    columns += list(model.extra_regressors)
+    columns += [s["condition_name"] for s in model.seasonalities.values()
+                if s.get("condition_name") is not None]
+    return [c for c in dict.fromkeys(columns) if c in training_data.columns]
+
+
+def model_digest(model):
+    config = [(name, getattr(model, name, None)) for name in MODEL_ATTRIBUTES]
+    if model.holidays is not None:
+        config.append(("holidays", frame_digest(model.holidays)))
+    return hashlib.sha256(repr(config).encode()).hexdigest()
+
+
+def unit_fingerprint(modelDate, forecast_end, data, product, warm_start=None,
+                     training_data=None, **prepare_kwargs):
+    """
+    Hash of everything prepare_frame's output for product and modelDate
+    depends on: the training data, the model's hyperparameters, the horizon
+    and the output options. Takes the same arguments as prepare_frame.
+    """
+    modelDate = pd.Timestamp(modelDate)
+    years = range(data.ds.min().year, forecast_end.year + 1)
+    if training_data is None:
+        training_data = data_filter(data[data.ds <= modelDate], product)
+    else:
+        training_data = training_data[training_data.ds <= modelDate]
+    model = get_model(product, years)
+    parts = [
+        FINGERPRINT_VERSION,
+        product,
+        str(modelDate.date()),
+        str(pd.Timestamp(forecast_end).date()),
+        frame_digest(training_data[fit_columns(model, training_data)]),
+        model_digest(model),
+        sorted((k, repr(v)) for k, v in prepare_kwargs.items()),
+    ]
+    if prepare_kwargs.get("include_actuals", True):
+        actuals = data[data.ds <= modelDate]
+        parts.append(frame_digest(actuals[["ds", "y"]]))
+    return hashlib.sha256(repr(parts).encode()).hexdigest()
+
+
+# Results are kept in cache_dir as one Parquet file per fingerprint
+def _result_path(cache_dir, fingerprint):
+    return os.path.join(cache_dir, "results", "{}.parquet".format(fingerprint))
+
+
+def load_result(cache_dir, fingerprint):
+    if cache_dir is None:
+        return None
+    path = _result_path(cache_dir, fingerprint)
+    if not os.path.exists(path):
+        return None
+    logging.info("Using cached result {}".format(fingerprint))
+    return pd.read_parquet(path)
+
+
+def store_result(cache_dir, fingerprint, frame):
+    if cache_dir is None:
+        return
+    path = _result_path(cache_dir, fingerprint)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    frame.to_parquet(path + ".tmp", index=False)
+    os.replace(path + ".tmp", path)
+
+
+# Fraction of FitCache.max_bytes left in use after an eviction
+EVICT_FRACTION = 0.9
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+class FitCache:
+    """
+    On-disk memo of backtest fits, for passing to backtest.backtest.
+
+    Each entry holds the forecast arrays of one fit and is keyed by the
+    model's hyperparameters, the training data and the forecast dates, so a
+    rerun with the same inputs skips the fit. Entries are .npz files in
+    directory; once they take up more than max_bytes, the least recently
+    used are deleted. Entries that can't be read count as misses and are
+    deleted. Hits and misses are counted per instance.
+
+    Several processes may share directory, so any entry may disappear at any
+    time.
+    """
+
+    def __init__(self, directory, max_bytes=1 << 30):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        # Running estimate of the size of the entries, rescanned on eviction
+        self._bytes = None
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, model, training_data, forecast_dates):
+        dates = np.asarray(forecast_dates, dtype="datetime64[ns]")
+        return hashlib.sha256(repr([
+            FINGERPRINT_VERSION,
+            model_digest(model),
+            frame_digest(training_data[fit_columns(model, training_data)]),
+            hashlib.sha256(dates.view("i8").tobytes()).hexdigest(),
+        ]).encode()).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, "{}.npz".format(key))
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with np.load(path) as entry:
+                result = (entry["ds"], entry["yhat"], entry["yhat_lower"], entry["yhat_upper"])
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        except (OSError, EOFError, ValueError, KeyError, zipfile.BadZipFile) as e:
+            logging.warning("Discarding unreadable fit cache entry {}: {}".format(path, e))
+            _remove(path)
+            self.misses += 1
+            return None
+        # The modification time orders entries for eviction
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        self.hits += 1
+        return result
+
+    def put(self, key, result):
+        ds, yhat, yhat_lower, yhat_upper = result
+        path = self._path(key)
+        # Named per process, so that concurrent puts of a key don't collide
+        tmp_path = "{}.{}.tmp".format(path, os.getpid())
+        with open(tmp_path, "wb") as f:
+            np.savez(f, ds=np.asarray(ds, dtype="datetime64[ns]"), yhat=yhat,
+                     yhat_lower=yhat_lower, yhat_upper=yhat_upper)
+            size = f.tell()
+        os.replace(tmp_path, path)
+        if self._bytes is not None:
+            self._bytes += size
+        if self._bytes is None or self._bytes > self.max_bytes:
+            self._evict()
+
+    # (mtime, size, path) of each entry
+    def _entries(self):
+        entries = []
+        for path in glob.glob(os.path.join(self.directory, "*.npz")):
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    # Evicts down to EVICT_FRACTION of max_bytes, so that the directory is
+    # rescanned once per batch of evictions rather than on every put.
+    def _evict(self):
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        if total > self.max_bytes:
+            for _, size, path in entries:
+                if total <= self.max_bytes * EVICT_FRACTION:
+                    break
+                _remove(path)
+                total -= size
+        self._bytes = total
+
+    def info(self):
+        sizes = [size for _, size, _ in self._entries()]
+        return {
+            "hits": self.hits, "misses": self.misses,
+            "entries": len(sizes), "bytes": sum(sizes),
+        }
@@ -5,6 +5,10 @@
 """
 Tools for getting metric actual or forecast data from BigQuery.
 """
+import hashlib
+import logging
+import os
+
 import pandas as pd
 
 
@@ -16,6 +20,8 @@ KPI_QUERIES = {
             SUM(IF(country IN ('US', 'FR', 'DE', 'GB', 'CA'), mau, 0)) AS tier1_mau
         FROM
             `moz-fx-data-shared-prod.telemetry.firefox_desktop_exact_mau28_by_dimensions_v1`
+        WHERE
+            {date_filter}
         GROUP BY
             date
         ORDER BY
@@ -28,6 +34,8 @@ KPI_QUERIES = {
             SUM(tier1_mau) AS tier1_mau
         FROM
             `moz-fx-data-shared-prod.telemetry.firefox_nondesktop_exact_mau28_by_product_v1`
+        WHERE
+            {date_filter}
         GROUP BY
             submission_date
         ORDER BY
@@ -40,6 +48,8 @@ KPI_QUERIES = {
             SUM(seen_in_tier1_country_mau) AS tier1_mau
         FROM
             `moz-fx-data-shared-prod.telemetry.firefox_accounts_exact_mau28_by_dimensions_v1`
+        WHERE
+            {date_filter}
         GROUP BY
             submission_date
         ORDER BY
@@ -48,7 +58,78 @@ KPI_QUERIES = {
 }
 
 
-def get_kpi_data(bq_client, types=tuple(KPI_QUERIES.keys())):
+# The expression each query's date_filter applies to
+DATE_EXPRESSIONS = {
+    "Desktop": "submission_date",
+    "Mobile": "submission_date",
+    "FxA": "submission_date",
+    "nondesktop": "submission_date",
+    "fxasub": "DATE(timestamp)",
+}
+
+
+def query_to_dataframe(bq_client, query, bqstorage_client=None):
+    # Results are fetched as Arrow record batches, streamed through the
+    # BigQuery Storage API when a client is given, and converted to a frame
+    # column by column rather than row by row.
+    return bq_client.query(query).result().to_arrow(
+        bqstorage_client=bqstorage_client
+    ).to_pandas()
+
+
+def _format_query(query, date_expression, since=None):
+    if since is None:
+        date_filter = "TRUE"
+    else:
+        date_filter = '{} > "{}"'.format(
+            date_expression, pd.Timestamp(since).date().isoformat()
+        )
+    return query.format(date_filter=date_filter)
+
+
+def run_query(bq_client, name, query, cache_dir=None, refresh=False, bqstorage_client=None):
+    """
+    Run one of the source queries above and return its results.
+
+    With a cache_dir, results are kept in a local Parquet snapshot per query
+    and only dates after the latest one in the snapshot are fetched and merged
+    in. Snapshots are named by a hash of the query as well, so a changed query
+    starts a new one. Pass refresh=True to discard the snapshot and refetch
+    the full history, e.g. after history has been restated.
+    """
+    date_expression = DATE_EXPRESSIONS[name]
+    if cache_dir is None:
+        return query_to_dataframe(
+            bq_client, _format_query(query, date_expression), bqstorage_client
+        )
+    digest = hashlib.sha256(repr((query, date_expression)).encode()).hexdigest()
+    path = os.path.join(cache_dir, "{}-{}.parquet".format(name, digest[:12]))
+    snapshot = None
+    if not refresh and os.path.exists(path):
+        snapshot = pd.read_parquet(path)
+    if snapshot is None or len(snapshot) == 0:
+        since = None
+    else:
+        since = snapshot['date'].max()
+    new_data = query_to_dataframe(
+        bq_client, _format_query(query, date_expression, since), bqstorage_client
+    )
+    new_data['date'] = pd.to_datetime(new_data['date'])
+    logging.info("Fetched {} rows for {} after {}".format(len(new_data), name, since))
+    if snapshot is not None:
+        new_data = pd.concat([snapshot, new_data], ignore_index=True).sort_values(
+            'date', kind='mergesort'
+        ).reset_index(drop=True)
+    os.makedirs(cache_dir, exist_ok=True)
+    # Write to a temporary file first so an interrupted run can't leave a
+    # truncated snapshot behind.
+    new_data.to_parquet(path + ".tmp", index=False)
+    os.replace(path + ".tmp", path)
+    return new_data
+
+
+def get_kpi_data(bq_client, types=tuple(KPI_QUERIES.keys()), cache_dir=None,
+                 refresh_cache=False, bqstorage_client=None):
     data = {}
     if isinstance(types, str):
         types = [types]
@@ -60,22 +141,27 @@ def get_kpi_data(bq_client, types=tuple(KPI_QUERIES.keys())):
                 break
         if q not in KPI_QUERIES.keys():
             raise ValueError('{} is not a valid KPI type'.format(q))
-        raw_data = bq_client.query(KPI_QUERIES[q]).to_dataframe()
-        data['{} Global MAU'.format(q)] = raw_data[
-            ["date", "global_mau"]
-        ].rename(
-            index=str, columns={"date": "ds", "global_mau": "y"}
+        raw_data = run_query(
+            bq_client, q, KPI_QUERIES[q], cache_dir, refresh_cache, bqstorage_client
         )
-        data['{} Tier1 MAU'.format(q)] = raw_data[
-            ["date", "tier1_mau"]
-        ].rename(
-            index=str, columns={"date": "ds", "tier1_mau": "y"}
-        )
-    for k in data:
-        data[k]['ds'] = pd.to_datetime(data[k]['ds']).dt.date
+        data.update(split_mau(raw_data, q))
     return data
 
 
+# Split a frame with date, global_mau and tier1_mau columns into the Global and
+# Tier1 MAU series for prefix, converting the dates only once.
+def split_mau(raw_data, prefix):
+    ds = pd.to_datetime(raw_data['date']).values
+    return {
+        '{} Global MAU'.format(prefix): pd.DataFrame({
+            'ds': ds, 'y': raw_data['global_mau'].values
+        }),
+        '{} Tier1 MAU'.format(prefix): pd.DataFrame({
+            'ds': ds, 'y': raw_data['tier1_mau'].values
+        }),
+    }
+
+
 NONDESKTOP_QUERY = '''
     SELECT
         submission_date as date,
@@ -84,6 +170,8 @@ NONDESKTOP_QUERY = '''
         product
     FROM
         `moz-fx-data-shared-prod.telemetry.firefox_nondesktop_exact_mau28_by_product_v1`
+    WHERE
+        {date_filter}
     GROUP BY
         submission_date,
         product
@@ -92,25 +180,16 @@ NONDESKTOP_QUERY = '''
     '''
 
 
-def get_nondesktop_data(bq_client):
+def get_nondesktop_data(bq_client, cache_dir=None, refresh_cache=False,
+                        bqstorage_client=None):
     data = {}
-    raw_data = bq_client.query(NONDESKTOP_QUERY).to_dataframe()
-    for p in [
-        "Fennec", "Focus iOS", "Focus Android", "Firefox iOS", "Fenix",
-        "Firefox Lite", "Firefox Echo", "Lockwise Android"
-    ]:
-        data['{} Global MAU'.format(p)] = raw_data.query("product == @p")[
-            ["date", "global_mau"]
-        ].rename(
-            index=str, columns={"date": "ds", "global_mau": "y"}
-        )
-        data['{} Tier1 MAU'.format(p)] = raw_data.query("product == @p")[
-            ["date", "tier1_mau"]
-        ].rename(
-            index=str, columns={"date": "ds", "tier1_mau": "y"}
-        )
-    for k in data:
-        data[k]['ds'] = pd.to_datetime(data[k]['ds']).dt.date
+    raw_data = run_query(
+        bq_client, "nondesktop", NONDESKTOP_QUERY, cache_dir, refresh_cache, bqstorage_client
+    )
+    # A single groupby partitions the frame by product, and picks up any
+    # product that appears in the data.
+    for p, product_data in raw_data.groupby("product", sort=False):
+        data.update(split_mau(product_data, p))
     return data
 
 
@@ -135,21 +214,22 @@ FXASUB_QUERY = '''
         )
         AND subscrib != ""
         AND DATE(timestamp) > "2019-06-03"
+        AND {date_filter}
     GROUP BY 1
     ORDER BY 1
     '''
 
 
-def get_fxasub_data(bq_client):
+def get_fxasub_data(bq_client, cache_dir=None, refresh_cache=False, bqstorage_client=None):
     name = 'FxA Registration with Subscription Tier1 DAU'
     data = {}
-    raw_data = bq_client.query(FXASUB_QUERY).to_dataframe()
-    data[name] = raw_data[
-        ["date", "value"]
-    ].rename(
-        index=str, columns={"date": "ds", "value": "y"}
+    raw_data = run_query(
+        bq_client, "fxasub", FXASUB_QUERY, cache_dir, refresh_cache, bqstorage_client
     )
-    data[name]['ds'] = pd.to_datetime(data[name]['ds']).dt.date
+    data[name] = pd.DataFrame({
+        'ds': pd.to_datetime(raw_data['date']).values,
+        'y': raw_data['value'].values,
+    })
     return data
 
 
@@ -172,20 +252,22 @@ FORECAST_QUERY = '''
 
 
 def get_forecast_data(
-    bq_client, project, dataset, table, product, asofdate_start, asofdate_end
+    bq_client, project, dataset, table, product, asofdate_start, asofdate_end,
+    bqstorage_client=None
 ):
-    raw_data = bq_client.query(FORECAST_QUERY.format(
+    raw_data = query_to_dataframe(bq_client, FORECAST_QUERY.format(
         project=project,
         dataset=dataset,
         table=table,
         product=product,
         asofdate_start=asofdate_start,
         asofdate_end=asofdate_end,
-    )).to_dataframe().rename(columns={
+    ), bqstorage_client).rename(columns={
         "date": "ds",
         "value": "yhat",
         "high90": "yhat_upper",
         "low90": "yhat_lower",
     })
-    raw_data['ds'] = pd.to_datetime(raw_data['ds']).dt.date
+    raw_data['ds'] = pd.to_datetime(raw_data['ds'])
+    raw_data['asofdate'] = pd.to_datetime(raw_data['asofdate'])
     return raw_data
@@ -0,0 +1,425 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+A local stand-in for bigquery.Client, so that the pipeline can be run and
+profiled against files instead of BigQuery.
+
+LocalClient implements the subset of the client interface the pipeline uses on
+top of DuckDB. Tables are named by their full BigQuery id, e.g.
+`moz-fx-data-shared-prod.telemetry.firefox_desktop_exact_mau28_by_dimensions_v1`,
+and source tables are read from Parquet files of that name in source_dir.
+Queries are written in BigQuery SQL; only the dialect differences the
+pipeline's own queries rely on are translated.
+"""
+import base64
+import os
+import re
+import threading
+from datetime import date
+
+import duckdb
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from google.cloud import bigquery
+from google.cloud.exceptions import Conflict, NotFound
+
+
+# DuckDB types for the BigQuery column types used by the pipeline
+DUCKDB_TYPES = {
+    "DATE": "DATE",
+    "STRING": "VARCHAR",
+    "FLOAT": "DOUBLE",
+    "FLOAT64": "DOUBLE",
+    "INTEGER": "BIGINT",
+    "INT64": "BIGINT",
+    "BOOLEAN": "BOOLEAN",
+    "BYTES": "BLOB",
+    "TIMESTAMP": "TIMESTAMP",
+}
+
+# Mobile products in the nondesktop source table
+SAMPLE_PRODUCTS = [
+    "Firefox iOS", "Firefox Lite", "Focus iOS", "Fenix", "Firefox Echo", "Fennec",
+    "Focus Android", "Lockwise Android",
+]
+
+# Records which field each time partitioned table is partitioned on
+PARTITIONING_TABLE = "_local_partitioning"
+
+_LITERALS = re.compile(r"`([^`]*)`|'(?:[^'\\]|\\.)*'|\"((?:[^\"\\]|\\.)*)\"")
+# String literals and quoted identifiers once translated to DuckDB
+_DUCKDB_LITERALS = re.compile(r"'(?:[^']|'')*'|\"(?:[^\"]|\"\")*\"")
+_CALLS = re.compile(r"(?<![\w.])(SPLIT|UNNEST|JSON_EXTRACT)\s*\(", re.IGNORECASE)
+_ALIAS = re.compile(r"\s+(?:AS\s+)?([A-Za-z_]\w*)", re.IGNORECASE)
+# Keywords that can follow UNNEST(...) when it has no alias
+_KEYWORDS = {
+    "AND", "OR", "AS", "ON", "USING", "WHERE", "GROUP", "HAVING", "QUALIFY", "WINDOW",
+    "ORDER", "LIMIT", "WITH", "JOIN", "CROSS", "INNER", "LEFT", "RIGHT", "FULL",
+    "UNION", "EXCEPT", "INTERSECT", "THEN", "ELSE", "END", "WHEN",
+}
+
+
+def _table_name(table):
+    if isinstance(table, str):
+        return table
+    return "{}.{}.{}".format(table.project, table.dataset_id, table.table_id)
+
+
+def _quote(name):
+    return '"{}"'.format(name.replace('"', '""'))
+
+
+# Rewrite calls whose BigQuery forms DuckDB doesn't accept. SPLIT splits on
+# commas when no delimiter is given, while string_split requires one.
+# JSON_EXTRACT returns a string rather than DuckDB's JSON type. An alias after
+# UNNEST names the unnested values in BigQuery, but only the table in DuckDB,
+# so it is given as the column name too.
+def _translate_calls(sql):
+    translated = []
+    # The function each open parenthesis belongs to, if translated, and the
+    # number of commas inside it
+    calls = []
+    position = 0
+    while position < len(sql):
+        literal = _DUCKDB_LITERALS.match(sql, position)
+        call = _CALLS.match(sql, position)
+        if literal:
+            translated.append(literal.group(0))
+            position = literal.end()
+            continue
+        if call:
+            function = call.group(1).upper()
+            if function == "SPLIT":
+                translated.append("string_split(")
+            elif function == "JSON_EXTRACT":
+                translated.append("CAST(" + call.group(0))
+            else:
+                translated.append(call.group(0))
+            calls.append([function, 0])
+            position = call.end()
+            continue
+        char = sql[position]
+        translated.append(char)
+        position += 1
+        if char == "(":
+            calls.append([None, 0])
+        elif char == "," and calls:
+            calls[-1][1] += 1
+        elif char == ")" and calls:
+            function, commas = calls.pop()
+            if function == "SPLIT" and commas == 0:
+                translated.insert(-1, ", ','")
+            elif function == "JSON_EXTRACT":
+                translated.append(" AS VARCHAR)")
+            alias = _ALIAS.match(sql, position)
+            if function == "UNNEST" and alias and alias.group(1).upper() not in _KEYWORDS:
+                translated.append(" AS {0}({0})".format(alias.group(1)))
+                position = alias.end()
+    return "".join(translated)
+
+
+class LocalRowIterator:
+    def __init__(self, table):
+        self._table = table
+        self.total_rows = table.num_rows
+
+    def to_arrow(self, bqstorage_client=None, **kwargs):
+        return self._table
+
+    def to_dataframe(self, bqstorage_client=None, **kwargs):
+        return self._table.to_pandas()
+
+    # Table.to_pylist needs pyarrow 7, newer than anomdtct's pin
+    def __iter__(self):
+        return iter(self._table.to_pandas().to_dict("records"))
+
+
+class LocalJob:
+    def __init__(self, result=None):
+        self._result = result
+
+    def result(self, *args, **kwargs):
+        return self._result if self._result is not None else self
+
+    def to_dataframe(self, bqstorage_client=None, **kwargs):
+        return self.result().to_dataframe()
+
+
+class LocalClient:
+    """
+    Runs the pipeline's queries, loads and table operations against a DuckDB
+    database at path (in memory by default), with the Parquet files in
+    source_dir available as read-only source tables.
+    """
+
+    def __init__(self, path=":memory:", source_dir=None, project="local"):
+        self.project = project
+        self._connection = duckdb.connect(path)
+        # The pipeline runs queries from several threads at once
+        self._lock = threading.RLock()
+        self._execute(
+            "CREATE TABLE IF NOT EXISTS {} (table_name VARCHAR, field VARCHAR)".format(
+                PARTITIONING_TABLE)
+        )
+        if source_dir is not None:
+            for entry in sorted(os.listdir(source_dir)):
+                path = os.path.join(source_dir, entry)
+                if os.path.isdir(path):
+                    files = os.path.join(path, "*.parquet")
+                elif entry.endswith(".parquet"):
+                    files = path
+                    entry = entry[:-len(".parquet")]
+                else:
+                    continue
+                self._execute("CREATE OR REPLACE VIEW {} AS SELECT * FROM read_parquet('{}')".format(
+                    _quote(entry), files.replace("'", "''")))
+
+    def _execute(self, sql, parameters=None):
+        with self._lock:
+            if parameters is None:
+                return self._connection.execute(sql)
+            return self._connection.execute(sql, parameters)
+
+    def _fetch(self, sql, parameters=None):
+        with self._lock:
+            if parameters is None:
+                return self._connection.execute(sql).arrow()
+            return self._connection.execute(sql, parameters).arrow()
+
+    def _exists(self, name):
+        return self._fetch(
+            "SELECT table_name FROM information_schema.tables WHERE table_name = ?", [name]
+        ).num_rows > 0
+
+    def _partition_field(self, name):
+        fields = self._fetch(
+            "SELECT field FROM {} WHERE table_name = ?".format(PARTITIONING_TABLE), [name]
+        ).column("field").to_pylist()
+        return fields[0] if fields else None
+
+    def _set_partition_field(self, name, field):
+        self._execute("DELETE FROM {} WHERE table_name = ?".format(PARTITIONING_TABLE), [name])
+        if field is not None:
+            self._execute("INSERT INTO {} VALUES (?, ?)".format(PARTITIONING_TABLE), [name, field])
+
+    def translate(self, sql):
+        """Rewrite BigQuery SQL into the DuckDB dialect."""
+        names = self._fetch("SELECT table_name FROM information_schema.tables").column(
+            "table_name").to_pylist()
+        # Longest first, so that no name is replaced inside a longer one
+        bare_names = sorted((n for n in names if "." in n), key=len, reverse=True)
+
+        def code(text):
+            for name in bare_names:
+                text = re.sub(r"(?<![\w.\"-]){}(?![\w-])".format(re.escape(name)),
+                              _quote(name), text)
+            text = re.sub(r"\bFLOAT64\b", "DOUBLE", text)
+            text = re.sub(r"\bINT64\b", "BIGINT", text)
+            text = re.sub(r"\bSAFE_CAST\(", "TRY_CAST(", text)
+            return re.sub(r"\bDATE\(([^()]*)\)", r"CAST(\1 AS DATE)", text)
+
+        translated = []
+        position = 0
+        for match in _LITERALS.finditer(sql):
+            translated.append(code(sql[position:match.start()]))
+            identifier, string = match.group(1), match.group(2)
+            if identifier is not None:
+                # BigQuery quotes identifiers with backticks
+                translated.append(_quote(identifier))
+            elif string is not None:
+                # and allows double-quoted string literals
+                translated.append("'{}'".format(string.replace("'", "''")))
+            else:
+                translated.append(match.group(0))
+            position = match.end()
+        translated.append(code(sql[position:]))
+        return _translate_calls("".join(translated))
+
+    def query(self, sql, **kwargs):
+        return LocalJob(LocalRowIterator(self._fetch(self.translate(sql))))
+
+    def dataset(self, dataset_id, project=None):
+        return bigquery.DatasetReference(project or self.project, dataset_id)
+
+    def get_table(self, table):
+        name = _table_name(table)
+        if not self._exists(name):
+            raise NotFound("Not found: Table {}".format(name))
+        result = bigquery.Table(name)
+        field = self._partition_field(name)
+        if field is not None:
+            result.time_partitioning = bigquery.table.TimePartitioning(field=field)
+        return result
+
+    def create_table(self, table, exists_ok=False):
+        name = _table_name(table)
+        if self._exists(name):
+            if exists_ok:
+                return self.get_table(name)
+            raise Conflict("Already Exists: Table {}".format(name))
+        self._create(name, table.schema)
+        if table.time_partitioning is not None:
+            self._set_partition_field(name, table.time_partitioning.field)
+        return self.get_table(name)
+
+    def _create(self, name, schema):
+        self._execute("CREATE TABLE {} ({})".format(_quote(name), ", ".join(
+            "{} {}{}".format(
+                _quote(field.name), DUCKDB_TYPES[field.field_type],
+                " NOT NULL" if field.mode == "REQUIRED" else "",
+            ) for field in schema
+        )))
+
+    def delete_table(self, table, not_found_ok=False):
+        name = _table_name(table)
+        if not self._exists(name):
+            if not_found_ok:
+                return
+            raise NotFound("Not found: Table {}".format(name))
+        self._execute("DROP TABLE {}".format(_quote(name)))
+        self._set_partition_field(name, None)
+
+    def copy_table(self, source, destination, job_config=None):
+        source, destination = _table_name(source), _table_name(destination)
+        if self._exists(destination):
+            if job_config is None or job_config.write_disposition != "WRITE_TRUNCATE":
+                raise Conflict("Already Exists: Table {}".format(destination))
+            self._execute("DROP TABLE {}".format(_quote(destination)))
+        self._execute("CREATE TABLE {} AS SELECT * FROM {}".format(
+            _quote(destination), _quote(source)))
+        self._set_partition_field(destination, self._partition_field(source))
+        return LocalJob()
+
+    def load_table_from_file(self, file_obj, destination, job_config=None, **kwargs):
+        if job_config.source_format != bigquery.SourceFormat.PARQUET:
+            raise ValueError("Only Parquet files can be loaded locally")
+        return self._load(pq.read_table(file_obj), destination, job_config)
+
+    def load_table_from_json(self, json_rows, destination, job_config=None, **kwargs):
+        frame = pd.DataFrame(list(json_rows), columns=[f.name for f in job_config.schema])
+        for field in job_config.schema:
+            if field.field_type == "DATE":
+                frame[field.name] = [
+                    date.fromisoformat(v) if isinstance(v, str) else v
+                    for v in frame[field.name]
+                ]
+            elif field.field_type == "BYTES":
+                # The JSON API takes BYTES values base64 encoded
+                frame[field.name] = [
+                    base64.b64decode(v) if isinstance(v, str) else v
+                    for v in frame[field.name]
+                ]
+        return self._load(pa.Table.from_pandas(frame, preserve_index=False),
+                          destination, job_config)
+
+    def _load(self, data, destination, job_config):
+        name, _, partition = _table_name(destination).partition("$")
+        columns = ", ".join(_quote(c) for c in data.column_names)
+        with self._lock:
+            self._connection.register("_local_load", data)
+            try:
+                if not self._exists(name):
+                    if job_config.schema:
+                        self._create(name, job_config.schema)
+                    else:
+                        self._execute("CREATE TABLE {} AS SELECT * FROM _local_load LIMIT 0".format(
+                            _quote(name)))
+                    if job_config.time_partitioning is not None:
+                        self._set_partition_field(name, job_config.time_partitioning.field)
+                disposition = job_config.write_disposition or "WRITE_APPEND"
+                if disposition == "WRITE_EMPTY" and self._fetch(
+                    "SELECT 1 FROM {} LIMIT 1".format(_quote(name))
+                ).num_rows > 0:
+                    raise Conflict("Table {} is not empty".format(name))
+                # Like a load job, the replacement is all or nothing
+                self._execute("BEGIN TRANSACTION")
+                try:
+                    if disposition == "WRITE_TRUNCATE" and partition:
+                        self._execute("DELETE FROM {} WHERE {} = ?".format(
+                            _quote(name), _quote(self._partition_column(name))
+                        ), [date(int(partition[:4]), int(partition[4:6]), int(partition[6:]))])
+                    elif disposition == "WRITE_TRUNCATE":
+                        self._execute("DELETE FROM {}".format(_quote(name)))
+                    self._execute("INSERT INTO {} ({}) SELECT {} FROM _local_load".format(
+                        _quote(name), columns, columns))
+                except Exception:
+                    self._execute("ROLLBACK")
+                    raise
+                self._execute("COMMIT")
+            finally:
+                self._connection.unregister("_local_load")
+        return LocalJob()
+
+    # Tables written through partition decorators without recorded
+    # partitioning are taken to be partitioned on their first DATE column.
+    def _partition_column(self, name):
+        field = self._partition_field(name)
+        if field is not None:
+            return field
+        columns = self._fetch(
+            "SELECT column_name FROM information_schema.columns "
+            "WHERE table_name = ? AND data_type = 'DATE' ORDER BY ordinal_position", [name]
+        ).column("column_name").to_pylist()
+        if not columns:
+            raise ValueError("Table {} has no DATE column to partition on".format(name))
+        return columns[0]
+
+    def close(self):
+        self._connection.close()
+
+
+def write_sample_sources(source_dir, start="2017-01-01", end="2019-12-31", seed=0):
+    """
+    Write synthetic source tables for every datasource to source_dir, for
+    running the pipeline against a LocalClient. MAU follows a trend with
+    weekly seasonality and noise; the FxA events hold one subscribed
+    registration per user.
+    """
+    random = np.random.RandomState(seed)
+    dates = pd.date_range(start, end).date
+    days = np.arange(len(dates))
+
+    def mau(level):
+        trend = level * (1 + 0.0002 * days) * (1 + 0.05 * np.sin(2 * np.pi * days / 7))
+        return np.round(trend * random.normal(1, 0.01, len(dates))).astype("int64")
+
+    tables = {}
+    countries = ["US", "FR", "DE", "GB", "CA", "Other"]
+    tables["telemetry.firefox_desktop_exact_mau28_by_dimensions_v1"] = pd.concat([
+        pd.DataFrame({"submission_date": dates, "country": country, "mau": mau(1e7)})
+        for country in countries
+    ], ignore_index=True)
+    tables["telemetry.firefox_nondesktop_exact_mau28_by_product_v1"] = pd.concat([
+        pd.DataFrame({
+            "submission_date": dates, "product": product,
+            "mau": mau(1e6), "tier1_mau": mau(5e5),
+        })
+        for product in SAMPLE_PRODUCTS
+    ], ignore_index=True)
+    tables["telemetry.firefox_accounts_exact_mau28_by_dimensions_v1"] = pd.DataFrame({
+        "submission_date": dates, "mau": mau(1e7), "seen_in_tier1_country_mau": mau(5e6),
+    })
+    registrations = np.repeat(pd.to_datetime(dates), random.poisson(20, len(dates)))
+    tables["firefox_accounts_derived.fxa_auth_events_v1"] = pd.DataFrame({
+        "timestamp": registrations + pd.to_timedelta(
+            random.randint(0, 86400, len(registrations)), unit="s"),
+        "jsonPayload": [
+            {"fields": {
+                "user_id": "user{}".format(i),
+                "event_type": "fxa_reg - complete",
+                "country": "United States",
+                "user_properties": '{"newsletters":["firefox-accounts-journey"]}',
+            }}
+            for i in range(len(registrations))
+        ],
+    })
+    os.makedirs(source_dir, exist_ok=True)
+    for name, frame in tables.items():
+        pq.write_table(
+            pa.Table.from_pandas(frame, preserve_index=False),
+            os.path.join(source_dir, "moz-fx-data-shared-prod.{}.parquet".format(name)),
+        )
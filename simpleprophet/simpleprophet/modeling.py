@@ -5,14 +5,24 @@
 """
 Tools for model development and evaluation.
 """
+import pandas as pd
 from plotly.offline import plot
 import plotly.graph_objs as go
 from fbprophet.plot import add_changepoints_to_plot
 
-from simpleprophet.utils import calc_mape
+from simpleprophet.utils import calc_mape, downsample_indices, scatter, table_output
 
 
-def evaluate_model(model, data, end_date=None, title=None):
+def evaluate_model(model, data, end_date=None, title=None, output="html", webgl=False,
+                   max_points=None):
+    """
+    Fit model on the training data and plot its forecast against the actuals,
+    with its MAPE on the holdout data.
+
+    As in validations, webgl and max_points control how the traces are drawn,
+    and output="frame", "parquet" or "json" returns the forecast table and
+    the holdout MAPE instead of any plots.
+    """
     model.fit(data["training"])
     holdout_period = model.make_future_dataframe(
         periods=len(data["holdout"]), include_history=False
@@ -21,23 +31,33 @@ def evaluate_model(model, data, end_date=None, title=None):
     if end_date is None:
         periods = len(data["holdout"])
     else:
-        periods = (end_date - data["training"].ds.max()).days
+        periods = (pd.Timestamp(end_date) - data["training"].ds.max()).days
     all_period = model.make_future_dataframe(periods=periods, include_history=True)
     all_forecast = model.predict(all_period)
+    mape = calc_mape(data["holdout"].y, holdout_forecast.yhat)
+    if output != "html":
+        return {
+            "mape": mape,
+            "forecast": table_output(
+                all_forecast[['ds', 'yhat', 'yhat_lower', 'yhat_upper']], output
+            ),
+        }
     text = '{}Holdout MAPE: {:,.2f}%'.format(
         "{} - ".format(title) if title is not None else "",
-        calc_mape(data["holdout"].y, holdout_forecast.yhat)
+        mape
     )
+    indices = downsample_indices(all_forecast['ds'], all_forecast['yhat'], max_points)
     plot_html = plot({"data": [
-        go.Scatter(x=data["all"]['ds'], y=data["all"]['y'], name='y'),
-        go.Scatter(x=all_forecast['ds'], y=all_forecast['yhat'], name='yhat'),
-        go.Scatter(
-            x=all_forecast['ds'], y=all_forecast['yhat_upper'], fill='tonexty',
-            mode='none', name='upper'
+        scatter(data["all"]['ds'], data["all"]['y'], webgl, max_points, name='y'),
+        scatter(all_forecast['ds'], all_forecast['yhat'], webgl, indices=indices,
+                name='yhat'),
+        scatter(
+            all_forecast['ds'], all_forecast['yhat_upper'], webgl, indices=indices,
+            fill='tonexty', mode='none', name='upper'
         ),
-        go.Scatter(
-            x=all_forecast['ds'], y=all_forecast['yhat_lower'], fill='tonexty',
-            mode='none', name='lower'
+        scatter(
+            all_forecast['ds'], all_forecast['yhat_lower'], webgl, indices=indices,
+            fill='tonexty', mode='none', name='lower'
         ),
     ], "layout": go.Layout(title=text)}, output_type='div')
     plot_prophet = model.plot(all_forecast)
@@ -6,8 +6,12 @@
 The current models and training data specification.
 """
 from fbprophet import Prophet
+import numpy as np
 import pandas as pd
+from collections import OrderedDict
 from datetime import date, timedelta
+from functools import lru_cache, partial
+import hashlib
 from simpleprophet.utils import s2d
 
 
@@ -27,6 +31,13 @@ def get_easters(year):
 
 # Get holidays dataframe in prophet's format
 def get_holidays(years):
+    return _get_holidays(tuple(years)).copy()
+
+
+# Holiday frames only depend on the year range, so they are built once per
+# range and copied out to each model.
+@lru_cache(maxsize=None)
+def _get_holidays(years):
     easters = pd.DataFrame({
         'ds': [e[1] for i in years for e in get_easters(i)],
         'holiday': [e[0] for i in years for e in get_easters(i)],
@@ -37,30 +48,29 @@ def get_holidays(years):
     return easters
 
 
-def setup_models(years):
-    release_dates = [
-        s2d("2018-05-09"), s2d("2018-06-26"), s2d("2018-09-05"), s2d("2018-10-23"),
-        s2d("2018-12-11"), s2d("2019-01-29"), s2d("2019-03-19"), s2d("2019-05-21"),
-        s2d("2019-07-09"), s2d("2019-09-03"), s2d("2019-10-22"), s2d("2019-12-03"),
-        s2d("2020-01-07"), s2d("2020-02-11"), s2d("2020-03-10"), s2d("2020-04-07"),
-        s2d("2020-05-05"), s2d("2020-06-02"), s2d("2020-06-30"), s2d("2020-07-28"),
-        s2d("2020-08-25"), s2d("2020-09-22"), s2d("2020-10-20"), s2d("2020-11-17"),
-        s2d("2020-12-15"),
-    ]
-    release_cycles_69_day = pd.DataFrame({
-        "ds": release_dates,
-        "holiday": "release",
-        "lower_window": 0,
-        "upper_window": 69
-    })
+RELEASE_DATES = [
+    s2d("2018-05-09"), s2d("2018-06-26"), s2d("2018-09-05"), s2d("2018-10-23"),
+    s2d("2018-12-11"), s2d("2019-01-29"), s2d("2019-03-19"), s2d("2019-05-21"),
+    s2d("2019-07-09"), s2d("2019-09-03"), s2d("2019-10-22"), s2d("2019-12-03"),
+    s2d("2020-01-07"), s2d("2020-02-11"), s2d("2020-03-10"), s2d("2020-04-07"),
+    s2d("2020-05-05"), s2d("2020-06-02"), s2d("2020-06-30"), s2d("2020-07-28"),
+    s2d("2020-08-25"), s2d("2020-09-22"), s2d("2020-10-20"), s2d("2020-11-17"),
+    s2d("2020-12-15"),
+]
+
 
-    release_cycles_14_day = pd.DataFrame({
-        "ds": release_dates,
+@lru_cache(maxsize=None)
+def _release_cycles(upper_window):
+    return pd.DataFrame({
+        "ds": RELEASE_DATES,
         "holiday": "release",
         "lower_window": 0,
-        "upper_window": 14
+        "upper_window": upper_window
     })
 
+
+@lru_cache(maxsize=None)
+def _fxa_holidays():
     monitor_pushes = pd.DataFrame({
         "ds": [
             s2d("2019-11-25")
@@ -69,16 +79,86 @@ def setup_models(years):
         "lower_window": 0,
         "upper_window": 30
     })
-    models = {}
-    models["Desktop Global MAU"] = Prophet(
-        yearly_seasonality=20,
-        changepoint_range=0.7,
-        seasonality_mode='multiplicative',
-        changepoint_prior_scale=0.008,
-        seasonality_prior_scale=0.25,
-        holidays=get_holidays(years)
-    )
-    models["Desktop Tier1 MAU"] = Prophet(
+    return pd.concat([_release_cycles(69), monitor_pushes], ignore_index=True)
+
+
+# Number of design matrices kept by CachedProphet across all models
+DESIGN_CACHE_SIZE = 64
+
+_design_cache = OrderedDict()
+_design_cache_stats = {"hits": 0, "misses": 0}
+
+
+def design_cache_info():
+    return dict(_design_cache_stats, size=len(_design_cache))
+
+
+def clear_design_cache():
+    _design_cache.clear()
+    _design_cache_stats.update(hits=0, misses=0)
+
+
+class CachedProphet(Prophet):
+    """
+    Prophet that shares its seasonality and holiday design matrices with every
+    other CachedProphet in the process.
+
+    The matrices only depend on the dates and on the seasonality and holiday
+    configuration, so identically configured models, e.g. the Global and
+    Tier1 models of a product, and repeated predicts over the same forecast
+    period build them only once.
+    """
+
+    def _design_key(self, df):
+        if self.extra_regressors or any(
+            props['condition_name'] is not None for props in self.seasonalities.values()
+        ):
+            return None
+        holidays = None
+        if self.holidays is not None:
+            holidays = pd.util.hash_pandas_object(self.holidays, index=False).values
+        train_holiday_names = None
+        if self.train_holiday_names is not None:
+            train_holiday_names = tuple(self.train_holiday_names)
+        digest = hashlib.sha256()
+        digest.update(df['ds'].values.astype('datetime64[ns]').view('i8').tobytes())
+        if holidays is not None:
+            digest.update(holidays.tobytes())
+        digest.update(repr((
+            list(self.seasonalities.items()), train_holiday_names,
+            getattr(self, 'country_holidays', None), self.seasonality_mode,
+            getattr(self, 'holidays_mode', None), self.holidays_prior_scale,
+        )).encode())
+        return digest.hexdigest()
+
+    def make_all_seasonality_features(self, df):
+        key = self._design_key(df)
+        if key is None:
+            return super().make_all_seasonality_features(df)
+        if key in _design_cache:
+            _design_cache.move_to_end(key)
+            _design_cache_stats["hits"] += 1
+            result, train_holiday_names = _design_cache[key]
+        else:
+            _design_cache_stats["misses"] += 1
+            result = super().make_all_seasonality_features(df)
+            # Building holiday features records the holidays seen in training
+            # on the model; replay that on hits.
+            train_holiday_names = self.train_holiday_names
+            _design_cache[key] = (result, train_holiday_names)
+            if len(_design_cache) > DESIGN_CACHE_SIZE:
+                _design_cache.popitem(last=False)
+        if self.train_holiday_names is None and train_holiday_names is not None:
+            self.train_holiday_names = train_holiday_names.copy()
+        seasonal_features, prior_scales, component_cols, modes = result
+        return (
+            seasonal_features.copy(), list(prior_scales), component_cols.copy(),
+            {mode: list(names) for mode, names in modes.items()},
+        )
+
+
+def _desktop_model(years):
+    return CachedProphet(
         yearly_seasonality=20,
         changepoint_range=0.7,
         seasonality_mode='multiplicative',
@@ -86,135 +166,181 @@ def setup_models(years):
         seasonality_prior_scale=0.25,
         holidays=get_holidays(years)
     )
-    models["Mobile Global MAU"] = Prophet(
-        changepoint_range=0.9, 
-        changepoint_prior_scale=0.03 
-        # change in Nov 2020 for better accuracy in forecasting w.r.t. Fennec to Fenix migration, 
-        # details see https://colab.research.google.com/drive/10vfzTOjiwnXODh1zwUtPVmtR8VqAKAtr#scrollTo=GMT0vF34251n
-    )
-    models["Mobile Tier1 MAU"] = Prophet(
+
+
+def _mobile_model(years):
+    return CachedProphet(
         changepoint_range=0.9,
         changepoint_prior_scale=0.03
         # change in Nov 2020 for better accuracy in forecasting w.r.t. Fennec to Fenix migration, 
         # details see https://colab.research.google.com/drive/10vfzTOjiwnXODh1zwUtPVmtR8VqAKAtr#scrollTo=GMT0vF34251n
     )
-    models["FxA Global MAU"] = Prophet(
-        changepoint_range=0.9,
-        changepoint_prior_scale=0.02,
-        seasonality_prior_scale=0.00002,
-        holidays=pd.concat([release_cycles_69_day, monitor_pushes], ignore_index=True),
-        seasonality_mode='multiplicative',
-        yearly_seasonality=10,
-    )
-    models["FxA Tier1 MAU"] = Prophet(
+
+
+def _fxa_model(years):
+    return CachedProphet(
         changepoint_range=0.9,
         changepoint_prior_scale=0.02,
         seasonality_prior_scale=0.00002,
-        holidays=pd.concat([release_cycles_69_day, monitor_pushes], ignore_index=True),
+        holidays=_fxa_holidays().copy(),
         seasonality_mode='multiplicative',
         yearly_seasonality=10,
     )
-    models["Fennec Global MAU"] = Prophet(
-        changepoint_prior_scale=0.0005,
-        seasonality_prior_scale=0.001,
-        seasonality_mode='multiplicative'
-    )
-    models["Focus iOS Global MAU"] = Prophet(changepoint_prior_scale=0.0005)
-    models["Focus Android Global MAU"] = Prophet(changepoint_prior_scale=0.005)
-    models["Firefox iOS Global MAU"] = Prophet(
-        changepoint_prior_scale=0.005,
-        seasonality_prior_scale=0.001,
-        seasonality_mode='multiplicative'
-    )
-    models["Fenix Global MAU"] = Prophet(changepoint_prior_scale=0.0005)
-    models["Firefox Lite Global MAU"] = Prophet(changepoint_prior_scale=0.0005)
-    models["Firefox Echo Global MAU"] = Prophet(changepoint_prior_scale=0.0005)
-    models["Lockwise Android Global MAU"] = Prophet(  # Not validated
-        changepoint_range=0.9,
-        changepoint_prior_scale=0.007,
-        seasonality_mode='multiplicative',
-    )
-    models["Fennec Tier1 MAU"] = Prophet(  # Not validated
+
+
+def _fennec_model(years):
+    return CachedProphet(
         changepoint_prior_scale=0.0005,
         seasonality_prior_scale=0.001,
         seasonality_mode='multiplicative'
     )
-    models["Focus iOS Tier1 MAU"] = Prophet(  # Not validated
-        changepoint_prior_scale=0.0005
-    )
-    models["Focus Android Tier1 MAU"] = Prophet(  # Not validated
-        changepoint_prior_scale=0.005
-    )
-    models["Firefox iOS Tier1 MAU"] = Prophet(  # Not validated
+
+
+def _firefox_ios_model(years):
+    return CachedProphet(
         changepoint_prior_scale=0.005,
         seasonality_prior_scale=0.001,
         seasonality_mode='multiplicative'
     )
-    models["Fenix Tier1 MAU"] = Prophet(  # Not validated
-        changepoint_prior_scale=0.0005
-    )
-    models["Firefox Lite Tier1 MAU"] = Prophet(  # Not validated
-        changepoint_prior_scale=0.0005
-    )
-    models["Firefox Echo Tier1 MAU"] = Prophet(  # Not validated
-        changepoint_prior_scale=0.0005
-    )
-    models["Lockwise Android Tier1 MAU"] = Prophet(
+
+
+def _lockwise_android_model(years):
+    return CachedProphet(
         changepoint_range=0.9,
         changepoint_prior_scale=0.007,
         seasonality_mode='multiplicative',
     )
-    models["FxA Registration with Subscription Tier1 DAU"] = Prophet(
+
+
+def _fxasub_model(years):
+    return CachedProphet(
         seasonality_mode='additive',
         changepoint_prior_scale=0.015,
-        holidays=release_cycles_14_day,
+        holidays=_release_cycles(14).copy(),
     )
-    return models
 
 
+def _changepoint_prophet(changepoint_prior_scale, years):
+    return CachedProphet(changepoint_prior_scale=changepoint_prior_scale)
+
+
+# A partial rather than a closure, so that the factories can be pickled and
+# sent to worker processes
+def _changepoint_model(changepoint_prior_scale):
+    return partial(_changepoint_prophet, changepoint_prior_scale)
+
+
+# Factories for the production models, keyed by datasource. Each takes the
+# range of years the model will see and returns an unfitted Prophet object.
+MODELS = {
+    "Desktop Global MAU": _desktop_model,
+    "Desktop Tier1 MAU": _desktop_model,
+    "Mobile Global MAU": _mobile_model,
+    "Mobile Tier1 MAU": _mobile_model,
+    "FxA Global MAU": _fxa_model,
+    "FxA Tier1 MAU": _fxa_model,
+    "Fennec Global MAU": _fennec_model,
+    "Focus iOS Global MAU": _changepoint_model(0.0005),
+    "Focus Android Global MAU": _changepoint_model(0.005),
+    "Firefox iOS Global MAU": _firefox_ios_model,
+    "Fenix Global MAU": _changepoint_model(0.0005),
+    "Firefox Lite Global MAU": _changepoint_model(0.0005),
+    "Firefox Echo Global MAU": _changepoint_model(0.0005),
+    "Lockwise Android Global MAU": _lockwise_android_model,  # Not validated
+    "Fennec Tier1 MAU": _fennec_model,  # Not validated
+    "Focus iOS Tier1 MAU": _changepoint_model(0.0005),  # Not validated
+    "Focus Android Tier1 MAU": _changepoint_model(0.005),  # Not validated
+    "Firefox iOS Tier1 MAU": _firefox_ios_model,  # Not validated
+    "Fenix Tier1 MAU": _changepoint_model(0.0005),  # Not validated
+    "Firefox Lite Tier1 MAU": _changepoint_model(0.0005),  # Not validated
+    "Firefox Echo Tier1 MAU": _changepoint_model(0.0005),  # Not validated
+    "Lockwise Android Tier1 MAU": _lockwise_android_model,
+    "FxA Registration with Subscription Tier1 DAU": _fxasub_model,
+}
+
+
+# Build only the model for a single datasource
+def get_model(product, years):
+    return MODELS[product](years)
+
+
+def setup_models(years):
+    return {product: get_model(product, years) for product in MODELS}
+
+
+# Dates before which each datasource's training data is not used
+START_DATES = {
+    "Desktop Global MAU": s2d('2016-04-08'),
+    "Desktop Tier1 MAU": s2d('2016-04-08'),
+    "Mobile Global MAU": s2d('2017-01-30'),
+    "Mobile Tier1 MAU": s2d('2017-01-30'),
+    "FxA Global MAU": s2d('2018-03-20'),
+    "FxA Tier1 MAU": s2d('2018-03-20'),
+    "Fennec Global MAU": s2d('2017-03-04'),
+    "Focus iOS Global MAU": s2d('2017-12-06'),
+    "Focus Android Global MAU": s2d('2017-07-17'),
+    "Firefox iOS Global MAU": s2d('2017-03-03'),
+    "Fenix Global MAU": s2d('2019-07-03'),
+    "Firefox Lite Global MAU": s2d('2017-03-04'),
+    "Firefox Echo Global MAU": s2d('2018-10-10'),
+    "Lockwise Android Global MAU": s2d('2017-01-30'),  # Not validated
+    "Lockwise Android Tier1 MAU": s2d('2017-01-30'),
+    "FxA Registration with Subscription Tier1 DAU": s2d('2019-06-04'),
+}
+
+# Inclusive date ranges excluded from each datasource's training data
+ANOMALY_DATES = {
+    "Desktop Global MAU": [[s2d('2019-05-16'), s2d('2019-06-07')]],
+    "Desktop Tier1 MAU": [[s2d('2019-05-16'), s2d('2019-06-07')]],
+    "Focus Android Global MAU": [[s2d('2018-09-01'), s2d('2019-03-01')]],
+    "Focus Android Tier1 MAU": [[s2d('2018-09-01'), s2d('2019-03-01')]],
+    "Firefox iOS Global MAU": [[s2d('2017-11-08'), s2d('2017-12-31')]],
+    "Firefox iOS Tier1 MAU": [[s2d('2017-11-08'), s2d('2017-12-31')]],
+    "Mobile Global MAU": [[s2d('2017-11-10'), s2d('2018-03-11')],
+                          [s2d('2019-12-04'), s2d('2020-01-27')], # EoY 2019 paid UAC campaign
+                          [s2d('2020-08-01'), s2d('2020-10-08')], # Fennec-> Fenix transition
+                         ],
+    "Mobile Tier1 MAU": [[s2d('2017-11-10'), s2d('2018-03-11')],
+                         [s2d('2019-12-04'), s2d('2020-01-27')],
+                         [s2d('2020-08-01'), s2d('2020-10-08')],
+                        ],
+    "FxA Registration with Subscription Tier1 DAU":
+        [[s2d('2019-11-23'), s2d('2019-12-02')]],
+}
+
+
+# Compile the start date and anomaly windows of a datasource into one sorted,
+# non-overlapping set of excluded date intervals.
+@lru_cache(maxsize=None)
+def excluded_intervals(product):
+    intervals = []
+    if product in START_DATES:
+        intervals.append((
+            pd.Timestamp("1900-01-01"),
+            pd.Timestamp(START_DATES[product]) - pd.Timedelta(days=1),
+        ))
+    intervals += [
+        (pd.Timestamp(start), pd.Timestamp(end))
+        for start, end in ANOMALY_DATES.get(product, [])
+    ]
+    merged = []
+    for start, end in sorted(intervals):
+        if merged and start <= merged[-1][1] + pd.Timedelta(days=1):
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return pd.IntervalIndex.from_tuples(merged, closed='both')
+
+
+# Boolean mask of the dates in ds that may be used to train product's model
+def training_mask(ds, product):
+    excluded = excluded_intervals(product)
+    if len(excluded) == 0:
+        return np.ones(len(ds), dtype=bool)
+    return excluded.get_indexer(np.asarray(ds, dtype='datetime64[ns]')) == -1
+
+
+# Drop the dates not used for training product's model. The result can be
+# reused for every model date by cutting it at that date.
 def data_filter(data, product):
-    start_dates = {
-        "Desktop Global MAU": s2d('2016-04-08'),
-        "Desktop Tier1 MAU": s2d('2016-04-08'),
-        "Mobile Global MAU": s2d('2017-01-30'),
-        "Mobile Tier1 MAU": s2d('2017-01-30'),
-        "FxA Global MAU": s2d('2018-03-20'),
-        "FxA Tier1 MAU": s2d('2018-03-20'),
-        "Fennec Global MAU": s2d('2017-03-04'),
-        "Focus iOS Global MAU": s2d('2017-12-06'),
-        "Focus Android Global MAU": s2d('2017-07-17'),
-        "Firefox iOS Global MAU": s2d('2017-03-03'),
-        "Fenix Global MAU": s2d('2019-07-03'),
-        "Firefox Lite Global MAU": s2d('2017-03-04'),
-        "Firefox Echo Global MAU": s2d('2018-10-10'),
-        "Lockwise Android Global MAU": s2d('2017-01-30'),  # Not validated
-        "Lockwise Android Tier1 MAU": s2d('2017-01-30'),
-        "FxA Registration with Subscription Tier1 DAU": s2d('2019-06-04'),
-    }
-
-    anomalyDates = {
-        "Desktop Global MAU": [[s2d('2019-05-16'), s2d('2019-06-07')]],
-        "Desktop Tier1 MAU": [[s2d('2019-05-16'), s2d('2019-06-07')]],
-        "Focus Android Global MAU": [[s2d('2018-09-01'), s2d('2019-03-01')]],
-        "Focus Android Tier1 MAU": [[s2d('2018-09-01'), s2d('2019-03-01')]],
-        "Firefox iOS Global MAU": [[s2d('2017-11-08'), s2d('2017-12-31')]],
-        "Firefox iOS Tier1 MAU": [[s2d('2017-11-08'), s2d('2017-12-31')]],
-        "Mobile Global MAU": [[s2d('2017-11-10'), s2d('2018-03-11')],
-                              [s2d('2019-12-04'), s2d('2020-01-27')], # EoY 2019 paid UAC campaign
-                              [s2d('2020-08-01'), s2d('2020-10-08')], # Fennec-> Fenix transition
-                             ],
-        "Mobile Tier1 MAU": [[s2d('2017-11-10'), s2d('2018-03-11')],
-                             [s2d('2019-12-04'), s2d('2020-01-27')],
-                             [s2d('2020-08-01'), s2d('2020-10-08')],
-                            ],
-        "FxA Registration with Subscription Tier1 DAU":
-            [[s2d('2019-11-23'), s2d('2019-12-02')]],
-    }
-    temp = data.copy()
-    if product in start_dates:
-        start_date = start_dates[product]  # noqa: F841
-        temp = temp.query("ds >= @start_date")
-    if product in anomalyDates:
-        for anomalystart_date, anomalyend_date in anomalyDates[product]:
-            temp = temp.query("(ds < @anomalystart_date) | (ds > @anomalyend_date)")
-    return temp
+    return data[training_mask(data.ds, product)]
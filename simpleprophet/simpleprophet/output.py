@@ -5,13 +5,21 @@
 """
 Tools for writing forecasts to BigQuery.
 """
+from concurrent.futures import ThreadPoolExecutor
+import io
+import logging
+import time
+
 import pandas as pd
 import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
 from google.cloud import bigquery
 from google.cloud.exceptions import NotFound
 from datetime import timedelta
 
-from simpleprophet.models import setup_models, data_filter
+from simpleprophet.models import get_model, data_filter
+from simpleprophet.utils import forecast_dates
 
 
 SCHEMA = [
@@ -42,6 +50,45 @@ SCHEMA = [
     ]
 
 
+ACTUALS_SCHEMA = [
+        bigquery.SchemaField(
+            "datasource", "STRING", mode="REQUIRED",
+            description="Identifier capturing data, model, and target metric"),
+        bigquery.SchemaField(
+            "date", "DATE", mode="REQUIRED",
+            description="Date that this particular row describes"),
+        bigquery.SchemaField(
+            "value", "FLOAT", mode="REQUIRED",
+            description="Actual value for the target metric"),
+    ]
+
+
+FINGERPRINT_SCHEMA = [
+        bigquery.SchemaField(
+            "asofdate", "DATE", mode="REQUIRED",
+            description="Latest date of actuals used for this model run"),
+        bigquery.SchemaField(
+            "datasource", "STRING", mode="REQUIRED",
+            description="Identifier capturing data, model, and target metric"),
+        bigquery.SchemaField(
+            "fingerprint", "STRING", mode="REQUIRED",
+            description="Hash of the inputs the forecast was made from"),
+    ]
+
+
+# Actuals, fingerprints and the combined view live next to the output table
+def actuals_table_name(table_name):
+    return table_name + "_actuals"
+
+
+def fingerprints_table_name(table_name):
+    return table_name + "_fingerprints"
+
+
+def view_name(table_name):
+    return table_name + "_with_actuals"
+
+
 # Delete output table if necessary and create empty table with appropriate schema
 def reset_output_table(bigquery_client, project, dataset, table_name):
     table_ref = '.'.join([project, dataset, table_name])
@@ -49,24 +96,261 @@ def reset_output_table(bigquery_client, project, dataset, table_name):
         bigquery_client.delete_table(table_ref)
     except NotFound:
         pass
+    return ensure_output_table(bigquery_client, project, dataset, table_name)
+
+
+# Create the output table unless it already exists
+def ensure_output_table(bigquery_client, project, dataset, table_name):
+    table_ref = '.'.join([project, dataset, table_name])
     table = bigquery.Table(table_ref, schema=SCHEMA)
     table.time_partitioning = bigquery.table.TimePartitioning(field="asofdate")
-    table = bigquery_client.create_table(table)
+    table = bigquery_client.create_table(table, exists_ok=True)
     return table
 
 
-def prepare_records(modelDate, forecast_end, data, product):
+# Get the (datasource, asofdate) units that have forecasts in the output table.
+# Each unit is written by a single load job, so a unit that is present at all
+# is complete.
+def get_completed_units(bigquery_client, project, dataset, table_name):
+    data = bigquery_client.query('''
+        SELECT DISTINCT
+            datasource,
+            asofdate
+        FROM
+            `{project}.{dataset}.{table}`
+        WHERE
+            type = 'forecast'
+    '''.format(project=project, dataset=dataset, table=table_name)).to_dataframe()
+    return set(zip(data['datasource'], pd.to_datetime(data['asofdate'])))
+
+
+# Atomically replace the destination table with the contents of the source
+# table, then drop the source.
+def swap_table(bigquery_client, project, dataset, source_name, destination_name):
+    source = '.'.join([project, dataset, source_name])
+    job_config = bigquery.CopyJobConfig(
+        write_disposition=bigquery.job.WriteDisposition.WRITE_TRUNCATE
+    )
+    bigquery_client.copy_table(
+        source, '.'.join([project, dataset, destination_name]), job_config=job_config
+    ).result()
+    bigquery_client.delete_table(source)
+
+
+def reset_actuals_table(bigquery_client, project, dataset, table_name):
+    table_ref = '.'.join([project, dataset, actuals_table_name(table_name)])
+    bigquery_client.delete_table(table_ref, not_found_ok=True)
+    return ensure_actuals_table(bigquery_client, project, dataset, table_name)
+
+
+def ensure_actuals_table(bigquery_client, project, dataset, table_name):
+    table_ref = '.'.join([project, dataset, actuals_table_name(table_name)])
+    table = bigquery.Table(table_ref, schema=ACTUALS_SCHEMA)
+    table.clustering_fields = ["datasource"]
+    return bigquery_client.create_table(table, exists_ok=True)
+
+
+# Create a view over the output and actuals tables with the same shape as an
+# output table written with actuals inline: one actual row per date up to each
+# asofdate of each datasource.
+def create_output_view(bigquery_client, project, dataset, table_name):
+    forecasts = '.'.join([project, dataset, table_name])
+    actuals = '.'.join([project, dataset, actuals_table_name(table_name)])
+    view = '.'.join([project, dataset, view_name(table_name)])
+    bigquery_client.query('''
+        CREATE OR REPLACE VIEW `{view}` AS
+        SELECT
+            *
+        FROM
+            `{forecasts}`
+        UNION ALL
+        SELECT
+            f.asofdate,
+            a.datasource,
+            a.date,
+            'actual' AS type,
+            a.value,
+            {nulls}
+        FROM
+            (SELECT DISTINCT asofdate, datasource FROM `{forecasts}` WHERE type = 'forecast') AS f
+        JOIN
+            `{actuals}` AS a
+        ON
+            a.datasource = f.datasource
+            AND a.date <= f.asofdate
+    '''.format(
+        view=view, forecasts=forecasts, actuals=actuals,
+        nulls=",\n            ".join(
+            "CAST(NULL AS FLOAT64) AS {}".format(f.name) for f in SCHEMA[5:]
+        ),
+    )).result()
+
+
+def ensure_fingerprints_table(bigquery_client, project, dataset, table_name):
+    table_ref = '.'.join([project, dataset, fingerprints_table_name(table_name)])
+    table = bigquery.Table(table_ref, schema=FINGERPRINT_SCHEMA)
+    table.time_partitioning = bigquery.table.TimePartitioning(field="asofdate")
+    return bigquery_client.create_table(table, exists_ok=True)
+
+
+# Get the fingerprints recorded for asofdate, keyed by datasource, keeping only
+# those whose forecasts are still present in the output table.
+def get_fingerprints(bigquery_client, project, dataset, table_name, asofdate):
+    try:
+        data = bigquery_client.query('''
+            SELECT
+                f.datasource,
+                f.fingerprint
+            FROM
+                `{project}.{dataset}.{fingerprints}` AS f
+            JOIN
+                (SELECT DISTINCT datasource FROM `{project}.{dataset}.{table}`
+                 WHERE asofdate = '{asofdate}' AND type = 'forecast') AS o
+            USING (datasource)
+            WHERE
+                f.asofdate = '{asofdate}'
+        '''.format(
+            project=project, dataset=dataset, table=table_name,
+            fingerprints=fingerprints_table_name(table_name), asofdate=asofdate,
+        )).to_dataframe()
+    except NotFound:
+        return {}
+    return dict(zip(data['datasource'], data['fingerprint']))
+
+
+# Prophet keeps its optimized parameters as (1, n) arrays; Stan expects an
+# init of scalars and vectors.
+def _stan_init(params):
+    return {
+        "k": params["k"][0][0],
+        "m": params["m"][0][0],
+        "sigma_obs": params["sigma_obs"][0][0],
+        "delta": params["delta"][0],
+        "beta": params["beta"][0],
+    }
+
+
+def fit_model(model_gen, data, warm_start=None):
+    """
+    Fit a fresh model from model_gen on data.
+
+    If warm_start is a dict, the optimizer is seeded with the parameters of
+    the previous fit stored in it, and the parameters and timing of this fit
+    are stored back for the next call.
+    """
+    model = model_gen()
+    init = None
+    if warm_start is not None and "params" in warm_start:
+        init = _stan_init(warm_start["params"])
+    start = time.time()
+    if init is not None:
+        try:
+            model.fit(data, init=init)
+        except (ValueError, RuntimeError) as e:
+            # Shapes change if e.g. the number of changepoints does; a Prophet
+            # object can only be fit once, so fall back to a fresh cold fit.
+            logging.warning("Warm start failed, fitting from scratch: {}".format(e))
+            init = None
+            model = model_gen()
+            model.fit(data)
+    else:
+        model.fit(data)
+    elapsed = time.time() - start
+    logging.info("Fit on {} rows took {:.2f}s ({} start)".format(
+        len(data), elapsed, "cold" if init is None else "warm"))
+    if warm_start is not None:
+        warm_start["params"] = model.params
+        warm_start.setdefault("fit_seconds", []).append(elapsed)
+    return model
+
+
+def forecast_quantiles(model, forecast_period, quantiles, chunk_days=None):
+    """
+    Forecast yhat and its percentiles for each date in forecast_period.
+
+    Returns a frame with ds, yhat, yhat_lower, yhat_upper and a pXX column per
+    quantile. Like Prophet.predict, yhat is the point forecast and the interval
+    matches the model's interval_width, but the interval and percentiles all
+    come from one set of posterior predictive samples.
+
+    The horizon is sampled chunk_days dates at a time so that peak memory is
+    bounded by the chunk rather than the horizon. The samples for each date have
+    the same marginal distribution whether or not the horizon is chunked.
+    """
+    lower_p = 100 * (1 - model.interval_width) / 2
+    upper_p = 100 * (1 + model.interval_width) / 2
+    percentiles = sorted(set(quantiles) | {lower_p, upper_p})
+    df = model.setup_dataframe(forecast_period.copy())
+    df['trend'] = model.predict_trend(df)
+    seasonal = model.predict_seasonal_components(df)
+    n = len(df)
+    chunk_days = min(chunk_days or n, n) or 1
+    result = np.empty((n, len(percentiles)))
+    for start in range(0, n, chunk_days):
+        samples = model.sample_posterior_predictive(
+            df.iloc[start:start + chunk_days].reset_index(drop=True)
+        )
+        result[start:start + chunk_days] = np.nanpercentile(
+            samples['yhat'], percentiles, axis=1
+        ).T
+    forecast = pd.DataFrame({
+        'ds': df['ds'],
+        'yhat': df['trend'] * (1 + seasonal['multiplicative_terms'])
+        + seasonal['additive_terms'],
+    })
+    columns = dict(zip(percentiles, result.T))
+    forecast['yhat_lower'] = columns[lower_p]
+    forecast['yhat_upper'] = columns[upper_p]
+    for q in quantiles:
+        forecast['p{}'.format(q)] = columns[q]
+    return forecast
+
+
+OUTPUT_COLUMNS = [
+    "asofdate", "datasource", "date", "type", "value", "low90", "high90",
+    "p10", "p20", "p30", "p40", "p50", "p60", "p70", "p80", "p90"
+]
+
+
+ARROW_TYPES = {"DATE": pa.date32(), "STRING": pa.string(), "FLOAT": pa.float64()}
+
+
+# Arrow equivalent of a BigQuery schema, used when loading frames as Parquet
+def arrow_schema(schema):
+    return pa.schema([
+        pa.field(f.name, ARROW_TYPES[f.field_type], nullable=f.mode != "REQUIRED")
+        for f in schema
+    ])
+
+
+def prepare_frame(modelDate, forecast_end, data, product, warm_start=None,
+                  sample_chunk_days=None, include_actuals=True, daily_days=None,
+                  coarse_freq="W", training_data=None):
+    """
+    Fit the model for product on data up to modelDate and return a frame of
+    forecast rows in the output table's layout, with native dates. Unless
+    include_actuals is False, the actuals up to modelDate are appended.
+
+    Forecasts are made daily up to forecast_end, or, if daily_days is given,
+    daily for that many days and then at coarse_freq.
+
+    training_data may be data already passed through data_filter, so that
+    consecutive model dates can share the filtering work.
+    """
+    # Dates are kept as datetime64 internally so comparisons stay vectorized
+    modelDate = pd.Timestamp(modelDate)
     minYear = data.ds.min().year
     maxYear = forecast_end.year
     years = range(minYear, maxYear + 1)
-    models = setup_models(years)
     forecast_start = modelDate + timedelta(days=1)
-    forecast_period = pd.DataFrame({'ds': pd.date_range(forecast_start, forecast_end)})
-    data = data.query("ds <= @modelDate")
+    forecast_period = pd.DataFrame({
+        'ds': forecast_dates(forecast_start, forecast_end, daily_days, coarse_freq)
+    })
+    data = data[data.ds <= modelDate]
     actuals_data = {
         "asofdate": modelDate,
         "datasource": product,
-        "date": pd.to_datetime(data.ds),
+        "date": data.ds,
         "type": "actual",
         "value": data.y,
         "low90": None,
@@ -76,16 +360,16 @@ def prepare_records(modelDate, forecast_end, data, product):
         "p{}".format(q): None
         for q in range(10, 100, 10)
     })
-    actuals_data = pd.DataFrame(actuals_data)[[
-      "asofdate", "datasource", "date", "type", "value", "low90", "high90",
-      "p10", "p20", "p30", "p40", "p50", "p60", "p70", "p80", "p90"
-    ]]
-    data = data_filter(data, product)
-    models[product].fit(data)
-    forecast_samples = models[product].sample_posterior_predictive(
-        models[product].setup_dataframe(forecast_period)
+    actuals_data = pd.DataFrame(actuals_data)[OUTPUT_COLUMNS]
+    if training_data is None:
+        data = data_filter(data, product)
+    else:
+        data = training_data[training_data.ds <= modelDate]
+    model = fit_model(lambda: get_model(product, years), data, warm_start)
+    quantiles = list(range(10, 100, 10))
+    forecast = forecast_quantiles(
+        model, forecast_period, quantiles, sample_chunk_days
     )
-    forecast = models[product].predict(forecast_period)
     output_data = {
         "asofdate": modelDate,
         "datasource": product,
@@ -96,27 +380,49 @@ def prepare_records(modelDate, forecast_end, data, product):
         "high90": forecast.yhat_upper,
     }
     output_data.update({
-        "p{}".format(q): np.nanpercentile(forecast_samples['yhat'], q, axis=1)
-        for q in range(10, 100, 10)
+        "p{}".format(q): forecast["p{}".format(q)]
+        for q in quantiles
     })
-    output_data = pd.DataFrame(output_data)[[
-      "asofdate", "datasource", "date", "type", "value", "low90", "high90",
-      "p10", "p20", "p30", "p40", "p50", "p60", "p70", "p80", "p90"
-    ]]
-    output_data = output_data.append(actuals_data, ignore_index=True)
+    output_data = pd.DataFrame(output_data)[OUTPUT_COLUMNS]
+    if include_actuals:
+        output_data = pd.concat([output_data, actuals_data], ignore_index=True)
+    output_data['asofdate'] = pd.to_datetime(output_data['asofdate'])
+    return output_data
+
+
+def frame_to_records(frame, schema=SCHEMA):
+    frame = frame[[f.name for f in schema]].copy()
     # We convert dates to strings here as the BigQuery loading machinery
     # writes out the records as JSON and expects ISO-formatted date strings.
-    output_data['asofdate'] = pd.to_datetime(
-        output_data['asofdate']
-    ).dt.strftime('%Y-%m-%d')
-    output_data['date'] = output_data['date'].dt.strftime('%Y-%m-%d')
-    return output_data.to_dict('records')
+    for f in schema:
+        if f.field_type == "DATE":
+            frame[f.name] = pd.to_datetime(frame[f.name]).dt.strftime('%Y-%m-%d')
+    # NaN is not valid JSON; missing values are loaded as NULL instead.
+    frame = frame.astype(object).where(frame.notnull(), None)
+    return frame.to_dict('records')
 
 
-def write_records(bigquery_client, records, table, write_disposition):
+def frame_to_arrow(frame, schema=SCHEMA):
+    target = arrow_schema(schema)
+    columns = []
+    for field in target:
+        values = frame[field.name]
+        if field.type == pa.date32():
+            values = pd.to_datetime(values).values.astype('datetime64[D]')
+        elif field.type == pa.float64():
+            values = values.astype(np.float64).values
+        columns.append(pa.array(values, type=field.type, from_pandas=True))
+    return pa.Table.from_arrays(columns, schema=target)
+
+
+def prepare_records(modelDate, forecast_end, data, product, **kwargs):
+    return frame_to_records(prepare_frame(modelDate, forecast_end, data, product, **kwargs))
+
+
+def write_records(bigquery_client, records, table, write_disposition, schema=SCHEMA):
     job_config = bigquery.LoadJobConfig(
         write_disposition=write_disposition,
-        schema=SCHEMA,
+        schema=schema,
     )
     load_job = bigquery_client.load_table_from_json(
         records,
@@ -127,6 +433,128 @@ def write_records(bigquery_client, records, table, write_disposition):
     load_job.result()
 
 
+def write_parquet(bigquery_client, frame, table, write_disposition, schema=SCHEMA):
+    buffer = io.BytesIO()
+    pq.write_table(frame_to_arrow(frame, schema), buffer)
+    buffer.seek(0)
+    job_config = bigquery.LoadJobConfig(
+        write_disposition=write_disposition,
+        source_format=bigquery.SourceFormat.PARQUET,
+    )
+    load_job = bigquery_client.load_table_from_file(
+        buffer,
+        table,
+        job_config=job_config,
+    )
+    # Wait for load job to complete; raises an exception if the job failed.
+    load_job.result()
+
+
+# Write a frame with the columns of schema, either as a Parquet file with
+# native DATE and FLOAT columns or through the JSON records path.
+def write_frame(bigquery_client, frame, table, write_disposition, output_format="parquet",
+                schema=SCHEMA):
+    if output_format == "parquet":
+        write_parquet(bigquery_client, frame, table, write_disposition, schema)
+    elif output_format == "json":
+        write_records(bigquery_client, frame_to_records(frame, schema), table,
+                      write_disposition, schema)
+    else:
+        raise ValueError('{} is not a valid output format'.format(output_format))
+
+
+class BufferedWriter:
+    """
+    Collects output frames for many model dates and loads them into table with
+    one load job per batch.
+
+    A batch is flushed once it holds max_rows rows or max_frames frames. Loads
+    run on a background thread so that fitting continues while a batch is
+    written; at most one load is in flight at a time. Rows are routed to their
+    asofdate partitions by the table's time partitioning, so table should be
+    the table itself rather than a partition decorator.
+    """
+
+    def __init__(self, bigquery_client, table, max_rows=1000000, max_frames=200,
+                 output_format="parquet",
+                 write_disposition=bigquery.job.WriteDisposition.WRITE_APPEND):
+        self.bigquery_client = bigquery_client
+        self.table = table
+        self.max_rows = max_rows
+        self.max_frames = max_frames
+        self.output_format = output_format
+        self.write_disposition = write_disposition
+        self._frames = []
+        self._rows = 0
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._pending = None
+
+    def write(self, frame):
+        self._frames.append(frame)
+        self._rows += len(frame)
+        if self._rows >= self.max_rows or len(self._frames) >= self.max_frames:
+            self.flush(wait=False)
+
+    def flush(self, wait=True):
+        if self._frames:
+            batch = pd.concat(self._frames, ignore_index=True)
+            self._frames = []
+            self._rows = 0
+            self._wait()
+            logging.info("Loading batch of {} rows into {}".format(len(batch), self.table))
+            self._pending = self._executor.submit(
+                write_frame, self.bigquery_client, batch, self.table,
+                self.write_disposition, self.output_format
+            )
+        if wait:
+            self._wait()
+
+    def _wait(self):
+        # Raises the exception of the previous load if it failed.
+        if self._pending is not None:
+            pending, self._pending = self._pending, None
+            pending.result()
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self._executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    # Stop without loading the buffered frames, e.g. after an error. A load
+    # already in flight is waited for, but its failure is only logged.
+    def abort(self):
+        self._frames = []
+        self._rows = 0
+        try:
+            self._wait()
+        except Exception:
+            logging.exception("Load into {} failed while aborting".format(self.table))
+        finally:
+            self._executor.shutdown()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+# Actuals for product in (after, until], in the layout of ACTUALS_SCHEMA
+def prepare_actuals(data, product, after, until):
+    if after is not None:
+        data = data[data.ds > pd.Timestamp(after)]
+    data = data[data.ds <= pd.Timestamp(until)]
+    return pd.DataFrame({
+        "datasource": product,
+        "date": data.ds,
+        "value": data.y,
+    })
+
+
 def write_forecasts(bigquery_client, table, modelDate, forecast_end, data, product,
                     write_disposition=bigquery.job.WriteDisposition.WRITE_APPEND):
     records = prepare_records(modelDate, forecast_end, data, product)
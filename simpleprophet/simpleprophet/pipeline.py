@@ -5,16 +5,26 @@
 """
 Single functions for running the forecasting pipeline.
 """
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from functools import partial
 from datetime import timedelta, date
 import logging
 
 from google.cloud import bigquery
 import pandas as pd
 
-from simpleprophet.output import (reset_output_table, write_forecasts,
-                                  prepare_records, write_records)
+from simpleprophet.output import (reset_output_table, prepare_frame, write_frame,
+                                  BufferedWriter, ACTUALS_SCHEMA, actuals_table_name,
+                                  ensure_actuals_table, reset_actuals_table,
+                                  prepare_actuals, create_output_view,
+                                  ensure_output_table, get_completed_units, swap_table,
+                                  FINGERPRINT_SCHEMA, ensure_fingerprints_table,
+                                  get_fingerprints)
+from simpleprophet.cache import unit_fingerprint, load_result, store_result
 from simpleprophet.data import get_kpi_data, get_nondesktop_data, get_fxasub_data
-from simpleprophet.utils import get_latest_date
+from simpleprophet.models import MODELS, data_filter, design_cache_info
+from simpleprophet.utils import get_latest_dates
 
 
 FIRST_MODEL_DATES = {
@@ -46,11 +56,194 @@ FIRST_MODEL_DATES = {
     'FxA Registration with Subscription Tier1 DAU': pd.to_datetime("2020-01-01").date(),
 }
 FORECAST_HORIZON = pd.to_datetime("2022-12-31").date()
+# Per-datasource overrides of FORECAST_HORIZON
+FORECAST_HORIZONS = {}
 DEFAULT_BQ_PROJECT = "mozdata"
 DEFAULT_BQ_DATASET = "tmp"
 DEFAULT_BQ_TABLE = "jklukas_forecasting_test"
 
 
+# Resumable rebuilds are written to this table next to the output table
+STAGING_SUFFIX = "_staging"
+
+# Number of consecutive model dates fit in sequence by one worker when warm
+# starting, so that each fit can be seeded with the previous day's parameters.
+WARM_START_RUN_LENGTH = 28
+
+
+# A run of model dates for one product, fit in sequence by a single worker
+ForecastJob = namedtuple(
+    "ForecastJob",
+    ["product", "model_dates", "data", "forecast_end", "warm_start", "prepare_kwargs"]
+)
+
+
+# Horizons may be given as ISO date strings, e.g. from the command line
+def _parse_horizon(horizon):
+    if isinstance(horizon, str):
+        return date.fromisoformat(horizon)
+    return horizon
+
+
+def get_forecast_horizon(product, horizon=None):
+    if horizon is not None:
+        return horizon
+    return FORECAST_HORIZONS.get(product, FORECAST_HORIZON)
+
+
+def _prepare_job(job):
+    fit_state = {} if job.warm_start else None
+    # The training data for each model date is a prefix of the filtered data
+    training_data = data_filter(job.data, job.product)
+    results = []
+    for model_date in job.model_dates:
+        logging.info("Processing {} forecast for {}".format(job.product, model_date))
+        results.append(prepare_frame(
+            model_date, job.forecast_end, job.data, job.product, warm_start=fit_state,
+            training_data=training_data, **job.prepare_kwargs
+        ))
+    if fit_state:
+        logging.info("{} fits for {} took {:.1f}s in total".format(
+            len(fit_state["fit_seconds"]), job.product, sum(fit_state["fit_seconds"])))
+    logging.info("Design matrix cache: {hits} hits, {misses} misses, {size} entries".format(
+        **design_cache_info()))
+    return results
+
+
+# Prepare output for each ForecastJob, yielding one frame per model date in
+# job order. With more than one worker the jobs are fanned out to a process
+# pool; results are still yielded in order so writes stay deterministic.
+def prepare_all(jobs, workers=1):
+    if workers is None or workers <= 1:
+        for job in jobs:
+            yield from _prepare_job(job)
+        return
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for job_results in executor.map(_prepare_job, jobs):
+            yield from job_results
+
+
+# Fits run in a process pool with more than one worker, otherwise on a single
+# background thread so that they can overlap with other work. The pool's
+# workers are forked on its first submit, so that is done here, before the
+# caller starts any threads: a child forked while another thread is inside an
+# HTTP or gRPC call can hang on the locks it copied.
+def _fit_executor(workers):
+    if workers is not None and workers > 1:
+        executor = ProcessPoolExecutor(max_workers=workers)
+        executor.submit(int).result()
+        return executor
+    return ThreadPoolExecutor(max_workers=1)
+
+
+def _backfill_jobs(data, start_dates, warm_start=False, horizon=None, prepare_kwargs=None,
+                   completed=frozenset()):
+    prepare_kwargs = prepare_kwargs or {}
+    run_length = WARM_START_RUN_LENGTH if warm_start else 1
+    jobs = []
+    for product in data.keys():
+        model_dates = [
+            d for d in pd.date_range(start_dates[product], data[product].ds.max())
+            if (product, d) not in completed
+        ]
+        jobs += [
+            ForecastJob(
+                product, model_dates[i:i + run_length], data[product],
+                get_forecast_horizon(product, horizon), warm_start, prepare_kwargs
+            )
+            for i in range(0, len(model_dates), run_length)
+        ]
+    return jobs
+
+
+def _write_all(bq_client, table, jobs, workers, output_format):
+    logging.info("Processing {} jobs with {} worker(s)".format(len(jobs), workers))
+    units = [(job.product, d) for job in jobs for d in job.model_dates]
+    with BufferedWriter(bq_client, table, output_format=output_format) as writer:
+        for (product, model_date), frame in zip(units, prepare_all(jobs, workers)):
+            logging.info("Buffering {} forecast for {:%Y-%m-%d}".format(product, model_date))
+            writer.write(frame)
+
+
+# Products are discovered from the source data; drop any that don't have a
+# production model yet.
+def _modeled(data):
+    for product in [p for p in data if p not in MODELS or p not in FIRST_MODEL_DATES]:
+        logging.warning("Skipping {}, which has no model".format(product))
+        del data[product]
+    return data
+
+
+# With actuals="separate", forecasts are written without the history of
+# actuals, which instead goes once into a deduplicated actuals table next to
+# the output table. A view over both has the shape of the inline output.
+def _check_actuals_mode(actuals, prepare_kwargs):
+    if actuals not in ("inline", "separate"):
+        raise ValueError('{} is not a valid actuals mode'.format(actuals))
+    prepare_kwargs["include_actuals"] = actuals == "inline"
+
+
+# Record the fingerprints of the forecasts just written to the model_date
+# partition, replacing any recorded for an earlier run.
+def _write_fingerprints(bq_client, project_id, dataset_id, table_id, model_date,
+                        fingerprints):
+    table = ensure_fingerprints_table(bq_client, project_id, dataset_id, table_id)
+    frame = pd.DataFrame({
+        "asofdate": pd.Timestamp(model_date),
+        "datasource": list(fingerprints.keys()),
+        "fingerprint": list(fingerprints.values()),
+    })
+    partition = "{}.{}.{}${:%Y%m%d}".format(
+        table.project, table.dataset_id, table.table_id, model_date
+    )
+    write_frame(bq_client, frame, partition,
+                write_disposition=bigquery.job.WriteDisposition.WRITE_TRUNCATE,
+                schema=FINGERPRINT_SCHEMA)
+
+
+# Append the actuals for each product that are newer than those already in
+# the actuals table, up to until_dates[product].
+def _write_actuals(bq_client, project_id, dataset_id, table_id, data, until_dates,
+                   output_format):
+    table = ensure_actuals_table(bq_client, project_id, dataset_id, table_id)
+    latest_dates = get_latest_dates(
+        bq_client, project_id, dataset_id, actuals_table_name(table_id), "date"
+    )
+    frame = pd.concat([
+        prepare_actuals(data[product], product, latest_dates.get(product), until)
+        for product, until in until_dates.items()
+    ], ignore_index=True)
+    logging.info("Appending {} new actuals to {}".format(len(frame), table.table_id))
+    if len(frame) > 0:
+        write_frame(bq_client, frame, table,
+                    write_disposition=bigquery.job.WriteDisposition.WRITE_APPEND,
+                    output_format=output_format, schema=ACTUALS_SCHEMA)
+
+
+def plan_updates(
+    bq_client, data, project_id=DEFAULT_BQ_PROJECT, dataset_id=DEFAULT_BQ_DATASET,
+    table_id=DEFAULT_BQ_TABLE, warm_start=False, horizon=None, prepare_kwargs=None
+):
+    """
+    Plan the forecasts still missing from the output table for each product in
+    data: every model date after the product's latest asofdate, up to the last
+    date of its data. The latest asofdates of all datasources are fetched with
+    a single query. Returns the work as a list of ForecastJob for prepare_all.
+    """
+    latest_dates = get_latest_dates(bq_client, project_id, dataset_id, table_id, "asofdate")
+    start_dates = {}
+    for product in data.keys():
+        latest_date = latest_dates.get(product)
+        if latest_date is not None and not pd.isnull(latest_date):
+            start_dates[product] = pd.Timestamp(latest_date) + timedelta(days=1)
+        else:
+            start_dates[product] = FIRST_MODEL_DATES[product]
+    jobs = _backfill_jobs(data, start_dates, warm_start, horizon, prepare_kwargs)
+    logging.info("Planned {} forecasts across {} datasources".format(
+        sum(len(job.model_dates) for job in jobs), len(data)))
+    return jobs
+
+
 def replace_single_day(
     bq_client,
     datasource,
@@ -58,78 +251,168 @@ def replace_single_day(
     project_id=DEFAULT_BQ_PROJECT,
     dataset_id=DEFAULT_BQ_DATASET,
     table_id=DEFAULT_BQ_TABLE,
+    workers=1,
+    output_format="parquet",
+    actuals="inline",
+    horizon=None,
+    cache_dir=None,
+    refresh_cache=False,
+    bqstorage_client=None,
+    force=False,
+    **prepare_kwargs
 ):
+    """
+    Forecast each product of datasource as of dt and replace the dt partition
+    of the output table with the results.
+
+    Every forecast is keyed by a fingerprint of its inputs. When the partition
+    already holds forecasts with the same fingerprints for every product,
+    nothing is refit or rewritten, so retries and reruns are cheap; pass
+    force=True to rewrite anyway. With a cache_dir, results are also kept
+    locally by fingerprint and reused instead of refitting.
+    """
+    _check_actuals_mode(actuals, prepare_kwargs)
     model_date = date.fromisoformat(dt)
-    data = {}
-    kpi_data = get_kpi_data(bq_client, types=[datasource])
-    data.update(kpi_data)
+    horizon = _parse_horizon(horizon)
+    fetch_kwargs = dict(
+        cache_dir=cache_dir, refresh_cache=refresh_cache, bqstorage_client=bqstorage_client
+    )
+    fetches = [partial(get_kpi_data, bq_client, types=[datasource], **fetch_kwargs)]
     if datasource.lower() == 'mobile':
-        nondesktop_data = get_nondesktop_data(bq_client)
-        data.update(nondesktop_data)
+        fetches.append(partial(get_nondesktop_data, bq_client, **fetch_kwargs))
     if datasource.lower() == 'fxa':
-        fxasub_data = get_fxasub_data(bq_client)
-        data.update(fxasub_data)
+        fetches.append(partial(get_fxasub_data, bq_client, **fetch_kwargs))
     partition_decorator = "$" + model_date.isoformat().replace('-', '')
     table = '.'.join([project_id, dataset_id, table_id]) + partition_decorator
-    records = []
-    for product in data.keys():
-        logging.info("Processing {} forecast for {}".format(product, model_date))
-        records += prepare_records(model_date, FORECAST_HORIZON, data[product], product)
-    logging.info("Replacing results for {} in {}".format(model_date, table))
-    write_records(bq_client, records, table,
-                  write_disposition=bigquery.job.WriteDisposition.WRITE_TRUNCATE)
+    stored = {} if force else get_fingerprints(
+        bq_client, project_id, dataset_id, table_id, model_date
+    )
+    # All source queries run at once on the shared client, and the models for
+    # each source are fit as soon as its data arrives. Products whose
+    # forecast in the partition is already current are only fit if another
+    # product's change means the partition has to be rewritten.
+    data = {}
+    jobs = {}
+    fingerprints = {}
+    frames = {}
+    fits = {}
+    with _fit_executor(workers) as fitter, \
+            ThreadPoolExecutor(max_workers=len(fetches)) as fetcher:
+        for fetch in as_completed([fetcher.submit(f) for f in fetches]):
+            source_data = _modeled(fetch.result())
+            data.update(source_data)
+            for product in source_data:
+                jobs[product] = ForecastJob(
+                    product, [model_date], source_data[product],
+                    get_forecast_horizon(product, horizon), False, prepare_kwargs
+                )
+                fingerprints[product] = unit_fingerprint(
+                    model_date, jobs[product].forecast_end, source_data[product],
+                    product, **prepare_kwargs
+                )
+                if stored.get(product) == fingerprints[product]:
+                    continue
+                frames[product] = load_result(cache_dir, fingerprints[product])
+                if frames[product] is None:
+                    fits[product] = fitter.submit(_prepare_job, jobs[product])
+        if fingerprints == stored:
+            logging.info("Results for {} in {} are current".format(model_date, table))
+        else:
+            for product in data:
+                if frames.get(product) is None and product not in fits:
+                    frames[product] = load_result(cache_dir, fingerprints[product])
+                    if frames[product] is None:
+                        fits[product] = fitter.submit(_prepare_job, jobs[product])
+            for product, fit in fits.items():
+                frames[product] = fit.result()[0]
+                store_result(cache_dir, fingerprints[product], frames[product])
+    if fingerprints != stored:
+        frame = pd.concat([frames[product] for product in data], ignore_index=True)
+        logging.info("Replacing results for {} in {}".format(model_date, table))
+        write_frame(bq_client, frame, table,
+                    write_disposition=bigquery.job.WriteDisposition.WRITE_TRUNCATE,
+                    output_format=output_format)
+        _write_fingerprints(
+            bq_client, project_id, dataset_id, table_id, model_date, fingerprints
+        )
+    if actuals == "separate":
+        _write_actuals(bq_client, project_id, dataset_id, table_id, data,
+                       {product: model_date for product in data}, output_format)
+        create_output_view(bq_client, project_id, dataset_id, table_id)
 
 
 def update_table(
     bq_client, project_id=DEFAULT_BQ_PROJECT, dataset_id=DEFAULT_BQ_DATASET,
-    table_id=DEFAULT_BQ_TABLE
+    table_id=DEFAULT_BQ_TABLE, workers=1, warm_start=False, output_format="parquet",
+    actuals="inline", horizon=None, cache_dir=None, refresh_cache=False,
+    bqstorage_client=None, **prepare_kwargs
 ):
-    kpi_data = get_kpi_data(bq_client)
-    nondesktop_data = get_nondesktop_data(bq_client)
+    _check_actuals_mode(actuals, prepare_kwargs)
+    horizon = _parse_horizon(horizon)
+    kpi_data = get_kpi_data(bq_client, cache_dir=cache_dir, refresh_cache=refresh_cache,
+                            bqstorage_client=bqstorage_client)
+    nondesktop_data = get_nondesktop_data(bq_client, cache_dir, refresh_cache, bqstorage_client)
     data = kpi_data
     data.update(nondesktop_data)
-    dataset = bq_client.dataset(dataset_id)
+    data = _modeled(data)
+    dataset = bq_client.dataset(dataset_id, project=project_id)
     tableref = dataset.table(table_id)
     table = bq_client.get_table(tableref)
-    for product in data.keys():
-        logging.info("Processing forecasts for {}".format(product))
-        latest_date = get_latest_date(
-            bq_client, project_id, dataset_id, table_id, product, "asofdate"
-        )
-        if latest_date is not None:
-            start_date = latest_date + timedelta(days=1)
-        else:
-            start_date = FIRST_MODEL_DATES[product]
-        model_dates = pd.date_range(
-            start_date,
-            data[product].ds.max()
-        )
-        for model_date in model_dates:
-            logging.info("Processing {} forecast for {}".format(product, model_date))
-            write_forecasts(
-                bq_client, table, model_date.date(),
-                FORECAST_HORIZON, data[product], product
-            )
+    jobs = plan_updates(
+        bq_client, data, project_id, dataset_id, table_id, warm_start, horizon, prepare_kwargs
+    )
+    _write_all(bq_client, table, jobs, workers, output_format)
+    if actuals == "separate":
+        _write_actuals(bq_client, project_id, dataset_id, table_id, data,
+                       {product: data[product].ds.max() for product in data}, output_format)
+        create_output_view(bq_client, project_id, dataset_id, table_id)
 
 
 def replace_table(
     bq_client, project_id=DEFAULT_BQ_PROJECT, dataset_id=DEFAULT_BQ_DATASET,
-    table_id=DEFAULT_BQ_TABLE
+    table_id=DEFAULT_BQ_TABLE, workers=1, warm_start=False, output_format="parquet",
+    actuals="inline", horizon=None, cache_dir=None, refresh_cache=False,
+    bqstorage_client=None, resumable=False, **prepare_kwargs
 ):
-    kpi_data = get_kpi_data(bq_client)
-    nondesktop_data = get_nondesktop_data(bq_client)
+    """
+    Regenerate the output table from scratch.
+
+    If resumable is True, the rebuild is written to a staging table instead and
+    any (datasource, asofdate) units already in it are skipped, so an
+    interrupted run can be restarted where it stopped. The staging table
+    replaces the output table in a single copy job once every unit is done.
+    """
+    _check_actuals_mode(actuals, prepare_kwargs)
+    horizon = _parse_horizon(horizon)
+    kpi_data = get_kpi_data(bq_client, cache_dir=cache_dir, refresh_cache=refresh_cache,
+                            bqstorage_client=bqstorage_client)
+    nondesktop_data = get_nondesktop_data(bq_client, cache_dir, refresh_cache, bqstorage_client)
     data = kpi_data
     data.update(nondesktop_data)
-    table = reset_output_table(bq_client, project_id, dataset_id, table_id)
-    for product in data.keys():
-        logging.info("Processing forecasts for {}".format(product))
-        model_dates = pd.date_range(
-            FIRST_MODEL_DATES[product],
-            data[product].ds.max()
-        )
-        for model_date in model_dates:
-            logging.info("Processing {} forecast for {}".format(product, model_date))
-            write_forecasts(
-                bq_client, table, model_date.date(),
-                FORECAST_HORIZON, data[product], product
-            )
+    data = _modeled(data)
+    if resumable:
+        target_id = table_id + STAGING_SUFFIX
+        table = ensure_output_table(bq_client, project_id, dataset_id, target_id)
+        completed = get_completed_units(bq_client, project_id, dataset_id, target_id)
+        logging.info("Resuming rebuild in {} with {} completed units".format(
+            target_id, len(completed)))
+    else:
+        target_id = table_id
+        table = reset_output_table(bq_client, project_id, dataset_id, target_id)
+        completed = frozenset()
+    if actuals == "separate" and not resumable:
+        reset_actuals_table(bq_client, project_id, dataset_id, target_id)
+    jobs = _backfill_jobs(
+        data, FIRST_MODEL_DATES, warm_start, horizon, prepare_kwargs, completed
+    )
+    _write_all(bq_client, table, jobs, workers, output_format)
+    if actuals == "separate":
+        _write_actuals(bq_client, project_id, dataset_id, target_id, data,
+                       {product: data[product].ds.max() for product in data}, output_format)
+    if resumable:
+        swap_table(bq_client, project_id, dataset_id, target_id, table_id)
+        if actuals == "separate":
+            swap_table(bq_client, project_id, dataset_id, actuals_table_name(target_id),
+                       actuals_table_name(table_id))
+    if actuals == "separate":
+        create_output_view(bq_client, project_id, dataset_id, table_id)
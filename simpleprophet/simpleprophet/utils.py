@@ -5,11 +5,15 @@
 """
 Various utility functions.
 """
+import io
+
 import numpy as np
 import pandas as pd
 import plotly.graph_objs as go
 from datetime import timedelta
 
+from simpleprophet.backtest import backtest
+
 
 # Calculate Mean Absolute Percentage Error of forecast
 def calc_mape(true, predicted):
@@ -28,6 +32,41 @@ def calc_log_ratio(true, predicted):
     return logratio
 
 
+# Per-observation terms of the metrics above, so that a metric can be
+# evaluated over many observations in one pass and reduced by group. Each
+# metric is the mean of its terms, ignoring NaN terms.
+def mape_terms(true, predicted):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(true != 0, np.fabs(true - predicted) / true * 100, np.nan)
+
+
+def mre_terms(true, predicted):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(true != 0, (true - predicted) / true * 100, np.nan)
+
+
+def log_ratio_terms(true, predicted):
+    return np.log(predicted) - np.log(true)
+
+
+METRIC_TERMS = {
+    calc_mape: mape_terms,
+    calc_mre: mre_terms,
+    calc_log_ratio: log_ratio_terms,
+}
+
+
+# Terms of metric for each observation. Metrics without a known elementwise
+# form are applied to each observation on its own.
+def metric_terms(metric, true, predicted):
+    true, predicted = np.asarray(true, dtype=float), np.asarray(predicted, dtype=float)
+    if metric in METRIC_TERMS:
+        return METRIC_TERMS[metric](true, predicted)
+    return np.array([
+        metric(true[i:i + 1], predicted[i:i + 1]) for i in range(len(true))
+    ], dtype=float)
+
+
 # Get most recent date in table
 def get_latest_date(bq_client, project, dataset, table, product, field):
     query = '''
@@ -41,15 +80,34 @@ def get_latest_date(bq_client, project, dataset, table, product, field):
         project=project, dataset=dataset, table=table, field=field, product=product
     )
     data = bq_client.query(query).to_dataframe()
-    if len(data) == 0:
+    if len(data) == 0 or pd.isnull(data['date'][0]):
         return None
-    return bq_client.query(query).to_dataframe()['date'][0]
+    return data['date'][0]
+
+
+# Get most recent date in table for every datasource, in a single query
+def get_latest_dates(bq_client, project, dataset, table, field):
+    query = '''
+        SELECT
+            datasource,
+            MAX({field}) as date
+        FROM
+            `{project}.{dataset}.{table}`
+        GROUP BY
+            datasource
+    '''.format(project=project, dataset=dataset, table=table, field=field)
+    data = bq_client.query(query).to_dataframe()
+    return dict(zip(data['datasource'], data['date']))
 
 
 def split_data(
     data, first_train_date, first_holdout_date, first_test_date, last_test_date
 ):
     temp = data.set_index('ds')
+    first_train_date, first_holdout_date, first_test_date, last_test_date = (
+        pd.Timestamp(d) for d in
+        (first_train_date, first_holdout_date, first_test_date, last_test_date)
+    )
     split_data = {
         "training": temp[
             first_train_date:(first_holdout_date - timedelta(days=1))
@@ -63,6 +121,18 @@ def split_data(
     return split_data
 
 
+# Dates to forecast from start to end: daily, or daily for the first
+# daily_days dates and then at coarse_freq (e.g. "W" or "MS") further out.
+def forecast_dates(start, end, daily_days=None, coarse_freq="W"):
+    daily = pd.date_range(start, end)
+    if daily_days is None or daily_days >= len(daily):
+        return daily
+    coarse = pd.date_range(
+        pd.Timestamp(start) + timedelta(days=daily_days), end, freq=coarse_freq
+    )
+    return daily[:daily_days].append(coarse)
+
+
 def s2d(date_string):
     return pd.to_datetime(date_string).date()
 
@@ -87,27 +157,68 @@ def get_layout(title, xaxis, yaxis):
     )
 
 
+# Indices of at most max_points points of the series (x, y) that keep its
+# visual shape, chosen with the Largest-Triangle-Three-Buckets algorithm. The
+# first and last points are always kept.
+def downsample_indices(x, y, max_points):
+    n = len(y)
+    if max_points is None or max_points < 3 or n <= max_points:
+        return np.arange(n)
+    x = np.asarray(x)
+    if np.issubdtype(x.dtype, np.datetime64):
+        x = x.astype("datetime64[ns]").view("i8")
+    x = x.astype(float)
+    y = np.nan_to_num(np.asarray(y, dtype=float))
+    edges = np.linspace(1, n - 1, max_points - 1).astype(int)
+    selected = np.empty(max_points, dtype=int)
+    selected[0] = 0
+    selected[-1] = n - 1
+    a = 0
+    for i in range(max_points - 2):
+        start, end = edges[i], edges[i + 1]
+        if i + 2 < len(edges):
+            next_x = x[end:edges[i + 2]].mean()
+            next_y = y[end:edges[i + 2]].mean()
+        else:
+            next_x, next_y = x[n - 1], y[n - 1]
+        areas = np.abs(
+            (x[a] - next_x) * (y[start:end] - y[a])
+            - (x[a] - x[start:end]) * (next_y - y[a])
+        )
+        a = start + int(np.argmax(areas))
+        selected[i + 1] = a
+    return selected
+
+
+# A line trace, as WebGL if webgl is set, with at most max_points points. Pass
+# the indices of another series to keep traces that share x aligned, e.g. a
+# forecast and its interval bounds.
+def scatter(x, y, webgl=False, max_points=None, indices=None, **kwargs):
+    x, y = np.asarray(x), np.asarray(y)
+    if indices is None:
+        indices = downsample_indices(x, y, max_points)
+    trace = go.Scattergl if webgl else go.Scatter
+    return trace(x=x[indices], y=y[indices], **kwargs)
+
+
+# Return a report's underlying table instead of its plot: as a frame, as
+# Parquet bytes or as a JSON string of records.
+def table_output(table, output):
+    if output == "frame":
+        return table
+    if output == "parquet":
+        buffer = io.BytesIO()
+        table.to_parquet(buffer, index=False)
+        return buffer.getvalue()
+    if output == "json":
+        return table.to_json(orient="records", date_format="iso")
+    raise ValueError('{} is not a valid report output'.format(output))
+
+
 def generate_forecast_data(
-    model_gen, metric_data, asofdate_range, target_date_range
+    model_gen, metric_data, asofdate_range, target_date_range, workers=1, cache=None
 ):
-    data = pd.DataFrame({
-        "ds": [],
-        "asofdate": [],
-        "yhat": [],
-        "yhat_lower": [],
-        "yhat_upper": [],
-    })
-    for asofdate in asofdate_range:
-        model = model_gen()
-        model.fit(metric_data.query("ds <= @asofdate"))
-        forecast_period = pd.DataFrame({'ds': target_date_range})
-        forecast = model.predict(forecast_period)
-        data = pd.concat([data, pd.DataFrame({
-            "ds": forecast.ds,
-            "asofdate": asofdate,
-            "yhat": forecast.yhat,
-            "yhat_lower": forecast.yhat_lower,
-            "yhat_upper": forecast.yhat_upper,
-        })], ignore_index=True)
-    data['ds'] = pd.to_datetime(data['ds']).dt.date
-    return data
+    return backtest(
+        model_gen, metric_data, asofdate_range, target_date_range,
+        workers=workers, cache=cache
+    )
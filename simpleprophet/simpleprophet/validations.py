@@ -4,66 +4,132 @@
 
 """
 Tools for valdiation and evaluation of forecast models.
+
+Each validation function returns an HTML div by default. webgl=True draws the
+traces with WebGL and max_points downsamples each trace to at most that many
+points. output="frame", "parquet" or "json" returns the table the plot would
+have been drawn from instead, without building the plot; its model column
+holds the key of each forecast in forecast_data_dict.
 """
 import pandas as pd
 import numpy as np
-from datetime import timedelta
-from collections import defaultdict
 from plotly.offline import plot
 import plotly.graph_objs as go
-from simpleprophet.utils import match_dates, get_layout
+from simpleprophet.backtest import backtest
+from simpleprophet.utils import (match_dates, get_layout, metric_terms, METRIC_TERMS,
+                                 downsample_indices, scatter, table_output)
+
+
+class ForecastStore:
+    """
+    Forecast data sorted by (asofdate, ds) for repeated lookups.
+
+    Build one from a frame with asofdate, ds, yhat, yhat_lower and yhat_upper
+    columns, such as the output of generate_forecast_data, and pass it to the
+    validation functions in place of the frame to avoid rescanning it for
+    every asofdate. Lookups are binary searches over the sorted columns.
+    """
+
+    def __init__(self, forecast_data):
+        self.data = pd.DataFrame({
+            "asofdate": pd.to_datetime(forecast_data["asofdate"]).values,
+            "ds": pd.to_datetime(forecast_data["ds"]).values,
+            "yhat": forecast_data["yhat"].values,
+            "yhat_lower": forecast_data["yhat_lower"].values,
+            "yhat_upper": forecast_data["yhat_upper"].values,
+        }).sort_values(["asofdate", "ds"], kind="mergesort").reset_index(drop=True)
+        self._asofdates = self.data["asofdate"].values
+        self._ds = self.data["ds"].values
+
+    def __len__(self):
+        return len(self.data)
 
+    # Positions of the rows for asofdate, optionally only those with ds in
+    # [first, last]
+    def _span(self, asofdate, first=None, last=None):
+        asofdate = np.datetime64(pd.Timestamp(asofdate))
+        start = np.searchsorted(self._asofdates, asofdate, side="left")
+        end = np.searchsorted(self._asofdates, asofdate, side="right")
+        if first is not None:
+            start += np.searchsorted(
+                self._ds[start:end], np.datetime64(pd.Timestamp(first)), side="left")
+        if last is not None:
+            end = start + np.searchsorted(
+                self._ds[start:end], np.datetime64(pd.Timestamp(last)), side="right")
+        return start, end
+
+    def forecasts(self, asofdates):
+        """The forecasts made as of each of asofdates, for dates after it."""
+        data = self.data
+        return data[
+            data.asofdate.isin(pd.to_datetime(asofdates)) & (data.ds > data.asofdate)
+        ]
 
-def _get_single_prediction(forecast_data, asofdate, target_date):
-    temp = forecast_data.query("asofdate == @asofdate & ds == @target_date")
-    if len(temp.yhat) == 1:
-        return (temp.yhat.item(), temp.yhat_lower.item(), temp.yhat_upper.item())
-    else:
-        return None
+    def predictions(self, asofdates, target_date):
+        """The predictions for target_date as of each of asofdates that has one."""
+        spans = [self._span(d, target_date, target_date) for d in asofdates]
+        rows = [start for start, end in spans if end - start == 1]
+        return self.data.iloc[rows].reset_index(drop=True)
+
+
+# Validation functions take either forecast frames or ForecastStores
+def as_forecast_store(forecast_data):
+    if isinstance(forecast_data, ForecastStore):
+        return forecast_data
+    return ForecastStore(forecast_data)
+
+
+# The per-model tables of a report as a single table
+def _report_table(data, output):
+    return table_output(pd.concat(
+        [frame.assign(model=k) for k, frame in data.items()], ignore_index=True
+    ), output)
 
 
 def validate_stability(
-    forecast_data_dict, asofdate_range, target_date, suppress_ci=False
+    forecast_data_dict, asofdate_range, target_date, suppress_ci=False,
+    output="html", webgl=False, max_points=None
 ):
     data = {}
     for forecast_data_key in forecast_data_dict:
-        dates = []
-        values = []
-        for asofdate in asofdate_range:
-            prediction = _get_single_prediction(
-                forecast_data_dict[forecast_data_key], asofdate, target_date)
-            if prediction is not None:
-                values.append([prediction])
-                dates.append(asofdate)
+        predictions = as_forecast_store(
+            forecast_data_dict[forecast_data_key]
+        ).predictions(asofdate_range, target_date)
         data[forecast_data_key] = pd.DataFrame({
-            "date": dates,
-            "Predicted MAU for {}".format(target_date): [i[0][0] for i in values],
-            "upper": [i[0][1] for i in values],
-            "lower": [i[0][2] for i in values],
+            "date": predictions.asofdate,
+            "Predicted MAU for {}".format(target_date): predictions.yhat,
+            "upper": predictions.yhat_lower,
+            "lower": predictions.yhat_upper,
         })
+    if output != "html":
+        return _report_table(data, output)
+    traces = []
+    for forecast_data_key in forecast_data_dict:
+        frame = data[forecast_data_key]
+        prediction = frame["Predicted MAU for {}".format(target_date)]
+        # The interval is sampled at the same dates as the prediction
+        indices = downsample_indices(frame['date'], prediction, max_points)
+        traces += [
+            scatter(
+                frame['date'], prediction, webgl, indices=indices,
+                name="Prediction for {}".format(forecast_data_key),
+            ),
+            scatter(
+                frame['date'], frame['upper'], webgl, indices=indices,
+                fill='tonexty',
+                mode='none',
+                name='upper 80% CI for {}'.format(forecast_data_key),
+            ) if not suppress_ci else go.Scatter(),
+            scatter(
+                frame['date'], frame['lower'], webgl, indices=indices,
+                fill='tonexty',
+                mode='none',
+                name='lower 80% CI for {}'.format(forecast_data_key),
+            ) if not suppress_ci else go.Scatter(),
+        ]
     return plot(
         {
-            "data": sum(([
-                go.Scatter(
-                    x=data[forecast_data_key]['date'],
-                    y=data[forecast_data_key]["Predicted MAU for {}".format(target_date)],
-                    name="Prediction for {}".format(forecast_data_key),
-                ),
-                go.Scatter(
-                    x=data[forecast_data_key]['date'],
-                    y=data[forecast_data_key]['upper'],
-                    fill='tonexty',
-                    mode='none',
-                    name='upper 80% CI for {}'.format(forecast_data_key),
-                ) if not suppress_ci else go.Scatter(),
-                go.Scatter(
-                    x=data[forecast_data_key]['date'],
-                    y=data[forecast_data_key]['lower'],
-                    fill='tonexty',
-                    mode='none',
-                    name='lower 80% CI for {}'.format(forecast_data_key),
-                ) if not suppress_ci else go.Scatter(),
-            ] for forecast_data_key in forecast_data_dict), []),
+            "data": traces,
             "layout": get_layout(
                 ("Predictions of MAU for {} using model "
                  "fit on data up to each date").format(target_date),
@@ -75,41 +141,45 @@ def validate_stability(
     )
 
 
-def _get_metric_for_range(actual_data, forecast_data, asofdate, metric):
-    forecast = forecast_data.query("asofdate == @asofdate & ds > @asofdate")
-    matched = match_dates(
-        actual_data,
-        forecast
-    )
-    metric = metric(
-        np.array(matched.y),
-        np.array(matched.yhat),
-    )
-    return metric
+# Actuals matched with the forecasts made as of each of asofdates, with the
+# horizon of each forecast in days
+def _matched_forecasts(actual_data, store, asofdates):
+    matched = match_dates(actual_data[["ds", "y"]], store.forecasts(asofdates))
+    matched["horizon"] = (matched.ds - matched.asofdate).dt.days
+    return matched
 
 
-def ValidateMetric(actual_data, forecast_data_dict, asofdate_range, metric, metric_name):
+def ValidateMetric(actual_data, forecast_data_dict, asofdate_range, metric, metric_name,
+                   output="html", webgl=False, max_points=None):
     """
     Produce a plot of an evaluation metric for a set of foreasting models over a
     range of model dates.
     """
+    asofdates = pd.to_datetime(list(asofdate_range))
     data = {}
     for k in forecast_data_dict:
-        dates = []
-        mapes = []
-        for d in asofdate_range:
-            mapes.append(
-                _get_metric_for_range(
-                    actual_data, forecast_data_dict[k], d, metric
-                )
+        matched = _matched_forecasts(
+            actual_data, as_forecast_store(forecast_data_dict[k]), asofdates
+        )
+        if metric in METRIC_TERMS:
+            matched["terms"] = metric_terms(metric, matched.y, matched.yhat)
+            values = matched.groupby("asofdate")["terms"].mean()
+        else:
+            values = matched.groupby("asofdate").apply(
+                lambda m: metric(np.array(m.y), np.array(m.yhat))
             )
-            dates.append(d)
-        data[k] = pd.DataFrame({"date": dates, metric_name: mapes})
+        data[k] = pd.DataFrame({
+            "date": asofdates,
+            metric_name: values.reindex(asofdates).values,
+        })
+    if output != "html":
+        return _report_table(data, output)
     return plot(
         {
-            "data": [go.Scatter(
-                x=data[k]['date'],
-                y=data[k][metric_name],
+            "data": [scatter(
+                data[k]['date'],
+                data[k][metric_name],
+                webgl, max_points,
                 name="{} for {}".format(metric_name, k)
             ) for k in forecast_data_dict],
             "layout": get_layout(
@@ -122,41 +192,28 @@ def ValidateMetric(actual_data, forecast_data_dict, asofdate_range, metric, metr
     )
 
 
-def _get_metric_trace(model, data, training_end_date, metric, metric_name):
-    forecast_start = training_end_date + timedelta(days=1)
-    forecast_end = data.ds.max()
-    model.fit(data.query("ds <= @training_end_date"))
-    forecast_period = pd.DataFrame({'ds': pd.date_range(forecast_start, forecast_end)})
-    forecast = model.predict(forecast_period)
-    matched = match_dates(
-        data,
-        forecast
-    )
-    return pd.DataFrame({
-        "ds": matched.ds,
-        metric_name: [
-            metric(
-                np.array(matched.query("ds == @d").y),
-                np.array(matched.query("ds == @d").yhat)
-            )
-            for d in matched.ds
-        ]
-    })
-
-
-def validate_traces(model_gen, data, training_end_date_range, metric, metric_name):
+def validate_traces(model_gen, data, training_end_date_range, metric, metric_name,
+                    workers=1, cache=None, output="html", webgl=False, max_points=None):
     """
     Produce a plot of model traces over time, with a seperate trace for a range
-    of model dates.
+    of model dates. The models are fit with backtest.backtest, which workers
+    and cache are passed to.
     """
-    traces = []
-    for d in training_end_date_range:
-        traces.append(_get_metric_trace(model_gen(), data, d, metric, metric_name))
+    forecasts = match_dates(
+        data[["ds", "y"]],
+        backtest(model_gen, data, training_end_date_range, workers=workers, cache=cache)
+    )
+    forecasts[metric_name] = metric_terms(metric, forecasts.y, forecasts.yhat)
+    if output != "html":
+        return table_output(forecasts[["asofdate", "ds", metric_name]], output)
+    traces = [
+        trace for _, trace in forecasts.groupby("asofdate", sort=False)
+    ]
     return plot(
         {
             "data":
                 [
-                    go.Scatter(x=d['ds'], y=d[metric_name])
+                    scatter(d['ds'], d[metric_name], webgl, max_points)
                     for d in traces
                 ],
                 "layout": get_layout(
@@ -169,25 +226,9 @@ def validate_traces(model_gen, data, training_end_date_range, metric, metric_nam
     )
 
 
-def _accumulate_horizon_metrics(
-    actual_data, forecast_data, asofdate, metric, metric_values
-):
-    forecast = forecast_data.query("asofdate == @asofdate & ds > @asofdate")
-    matched = match_dates(
-        actual_data,
-        forecast
-    )
-    for d in matched.ds:
-        metricValue = metric(
-            np.array(matched.query("ds == @d").y),
-            np.array(matched.query("ds == @d").yhat)
-        )
-        horizon = (d - asofdate).days
-        metric_values[horizon].append(metricValue)
-
-
 def validate_metric_horizon(
-    actual_data, forecast_data_dict, training_end_date_range, metric, metric_name
+    actual_data, forecast_data_dict, training_end_date_range, metric, metric_name,
+    output="html", webgl=False, max_points=None
 ):
     """
     Produce a plot of an evaluation metric for a set of foreasting models over a
@@ -195,20 +236,23 @@ def validate_metric_horizon(
     """
     data = {}
     for k in forecast_data_dict:
-        metricValues = defaultdict(lambda: [])
-        for d in training_end_date_range:
-            _accumulate_horizon_metrics(
-                actual_data, forecast_data_dict[k], d, metric, metricValues
-            )
+        matched = _matched_forecasts(
+            actual_data, as_forecast_store(forecast_data_dict[k]), training_end_date_range
+        )
+        matched["terms"] = metric_terms(metric, matched.y, matched.yhat)
+        values = matched.groupby("horizon")["terms"].mean()
         data[k] = pd.DataFrame({
-            "horizon": [i for i in metricValues.keys()],
-            metric_name: [np.mean(metricValues[h]) for h in metricValues.keys()]
+            "horizon": values.index,
+            metric_name: values.values,
         })
+    if output != "html":
+        return _report_table(data, output)
     return plot({
         "data": [
-            go.Scatter(
-                x=data[k]['horizon'],
-                y=data[k][metric_name],
+            scatter(
+                data[k]['horizon'],
+                data[k][metric_name],
+                webgl, max_points,
                 name="{} for {}".format(metric_name, k)
             )
             for k in forecast_data_dict